@@ -1,18 +1,39 @@
 #!/usr/bin/env python
 
 import socket
+import sys
 import io
+import time
+import collections
+import contextlib
+import bisect
+import fcntl
+import mmap
+import struct
+import tempfile
 import os
 import random
 import string
+import json
+import logging
+import re
 import datetime
+import hashlib
 import subprocess
+import cProfile
+import pstats
+import threading
+import concurrent.futures
 
+import MySQLdb.connections
+import MySQLdb.constants.CLIENT
 import MySQLdb.cursors
 import flask
+import werkzeug.wsgi
 import bcrypt
 import pathlib
 import requests
+import requests.adapters
 
 base_path = pathlib.Path(__file__).resolve().parent.parent
 static_folder = base_path / 'public'
@@ -21,6 +42,9 @@ app = flask.Flask(__name__, static_folder=str(static_folder), static_url_path=''
 app.config['SECRET_KEY'] = 'isucari'
 app.config['UPLOAD_FOLDER'] = '../public/upload'
 
+# name -> callable returning a dict of counters, served by /debug/stats.json
+debug_stats = {}
+
 
 class Constants(object):
     DEFAULT_PAYMENT_SERVICE_URL = "http://127.0.0.1:5555"
@@ -49,6 +73,104 @@ class Constants(object):
     TRANSACTIONS_PER_PAGE = 10
 
 
+class Queries(object):
+    # read-path queries shared by this app, asgi.py and explain_listing_queries(), so both apps run the
+    # same SQL and the index check sees the real query shapes
+    NEW_ITEMS = "SELECT * FROM `items` WHERE `status` IN (%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+    NEW_ITEMS_PAGING = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+
+    CATEGORY_ITEMS = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND category_id IN ({category_ids}) ORDER BY created_at DESC, id DESC LIMIT %s"
+    CATEGORY_ITEMS_PAGING = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND category_id IN ({category_ids}) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+
+    # seller OR buyer cannot be served by one index, so each side is a separate index seek merged by the caller
+    TRANSACTIONS = \
+        "(SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s,%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s)" \
+        " UNION ALL " \
+        "(SELECT * FROM `items` WHERE `buyer_id` = %s AND `status` IN (%s,%s,%s,%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s)"
+    TRANSACTIONS_PAGING = \
+        "(SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s)" \
+        " UNION ALL " \
+        "(SELECT * FROM `items` WHERE `buyer_id` = %s AND `status` IN (%s,%s,%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s)"
+
+    USER_ITEMS = "SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+    USER_ITEMS_PAGING = "SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+
+    TRANSACTION_EVIDENCES = "SELECT * FROM `transaction_evidences` WHERE `item_id` IN ({item_ids})"
+    SHIPPINGS = "SELECT `transaction_evidence_id`, `status`, `reserve_id` FROM `shippings` WHERE `transaction_evidence_id` IN ({transaction_evidence_ids})"
+    SHIPPINGS_DONE = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s WHERE `transaction_evidence_id` IN ({transaction_evidence_ids}) AND `status` != %s"
+
+    # the builders return (sql, params); created_at and item_id are the paging parameters, 0 on the first page
+
+    @staticmethod
+    def placeholders(values):
+        return ",".join(["%s"] * len(values))
+
+    @staticmethod
+    def cursor(created_at, item_id):
+        since = datetime.datetime.fromtimestamp(created_at)
+        return since, since, item_id
+
+    @classmethod
+    def new_items(cls, created_at, item_id):
+        statuses = (Constants.ITEM_STATUS_ON_SALE, Constants.ITEM_STATUS_SOLD_OUT)
+        if item_id > 0 and created_at > 0:
+            return cls.NEW_ITEMS_PAGING, (*statuses, *cls.cursor(created_at, item_id), Constants.ITEMS_PER_PAGE + 1)
+        return cls.NEW_ITEMS, (*statuses, Constants.ITEMS_PER_PAGE + 1)
+
+    @classmethod
+    def category_items(cls, category_ids, created_at, item_id):
+        statuses = (Constants.ITEM_STATUS_ON_SALE, Constants.ITEM_STATUS_SOLD_OUT)
+        in_category_ids = cls.placeholders(category_ids)
+        if item_id > 0 and created_at > 0:
+            return cls.CATEGORY_ITEMS_PAGING.format(category_ids=in_category_ids), (
+                *statuses, *category_ids, *cls.cursor(created_at, item_id), Constants.ITEMS_PER_PAGE + 1)
+        return cls.CATEGORY_ITEMS.format(category_ids=in_category_ids), (
+            *statuses, *category_ids, Constants.ITEMS_PER_PAGE + 1)
+
+    @classmethod
+    def transactions(cls, user_id, created_at, item_id):
+        statuses = (
+            Constants.ITEM_STATUS_ON_SALE,
+            Constants.ITEM_STATUS_TRADING,
+            Constants.ITEM_STATUS_SOLD_OUT,
+            Constants.ITEM_STATUS_CANCEL,
+            Constants.ITEM_STATUS_STOP,
+        )
+        if item_id > 0 and created_at > 0:
+            sql = cls.TRANSACTIONS_PAGING
+            params = (user_id, *statuses, *cls.cursor(created_at, item_id), Constants.TRANSACTIONS_PER_PAGE + 1)
+        else:
+            sql = cls.TRANSACTIONS
+            params = (user_id, *statuses, Constants.TRANSACTIONS_PER_PAGE + 1)
+        # once for the seller side and once for the buyer side
+        return sql, params * 2
+
+    @classmethod
+    def user_items(cls, user_id, created_at, item_id):
+        statuses = (Constants.ITEM_STATUS_ON_SALE, Constants.ITEM_STATUS_TRADING, Constants.ITEM_STATUS_SOLD_OUT)
+        if item_id > 0 and created_at > 0:
+            return cls.USER_ITEMS_PAGING, (user_id, *statuses, *cls.cursor(created_at, item_id), Constants.ITEMS_PER_PAGE + 1)
+        return cls.USER_ITEMS, (user_id, *statuses, Constants.ITEMS_PER_PAGE + 1)
+
+    @classmethod
+    def transaction_evidences(cls, item_ids):
+        return cls.TRANSACTION_EVIDENCES.format(item_ids=cls.placeholders(item_ids)), tuple(item_ids)
+
+    @classmethod
+    def shippings(cls, transaction_evidence_ids):
+        return cls.SHIPPINGS.format(transaction_evidence_ids=cls.placeholders(transaction_evidence_ids)), \
+            tuple(transaction_evidence_ids)
+
+    @classmethod
+    def shippings_done(cls, transaction_evidence_ids):
+        return cls.SHIPPINGS_DONE.format(transaction_evidence_ids=cls.placeholders(transaction_evidence_ids)), (
+            Constants.SHIPPING_STATUS_DONE,
+            datetime.datetime.now(),
+            *transaction_evidence_ids,
+            Constants.SHIPPING_STATUS_DONE,
+        )
+
+
 class HttpException(Exception):
     status_code = 500
 
@@ -58,31 +180,248 @@ class HttpException(Exception):
         self.status_code = status_code
 
     def get_response(self):
-        response = flask.jsonify({'error': self.message})
+        response = jsonify({'error': self.message})
         response.status_code = self.status_code
         return response
 
 
+class PooledConnection(MySQLdb.connections.Connection):
+    in_transaction = False
+
+    def begin(self):
+        super().begin()
+        self.in_transaction = True
+
+    def commit(self):
+        super().commit()
+        self.in_transaction = False
+
+    def rollback(self):
+        super().rollback()
+        self.in_transaction = False
+
+
+class InstrumentedCursorMixin(object):
+
+    def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            elapsed = time.perf_counter() - started
+            request_metrics.add('db', elapsed)
+            query_stats.record(query, args, elapsed, self.rowcount)
+
+
+class DictCursor(InstrumentedCursorMixin, MySQLdb.cursors.DictCursor):
+    pass
+
+
+# rowcount is not known until the result has been read, so streamed statements are recorded with 0 rows
+class SSDictCursor(InstrumentedCursorMixin, MySQLdb.cursors.SSDictCursor):
+    pass
+
+
+class PoolTimeout(MySQLdb.OperationalError):
+    pass
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect_args, min_size=1, max_size=10, timeout=5.0, ping_interval=1.0):
+        self.connect_args = connect_args
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._size = 0
+        self._filled = False
+
+        self.acquires = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.discards = 0
+
+    def _connect(self):
+        conn = PooledConnection(**self.connect_args)
+        with conn.cursor() as c:
+            c.execute(
+                "SET SESSION sql_mode='STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION'")
+        with self._cond:
+            self.connects += 1
+        return conn
+
+    def _fill(self):
+        conns = []
+        try:
+            for _ in range(self.min_size):
+                conns.append(self._connect())
+        finally:
+            with self._cond:
+                now = time.monotonic()
+                for conn in conns:
+                    self._idle.append((conn, now))
+                self._size += len(conns)
+                self._cond.notify_all()
+
+    def acquire(self):
+        if not self._filled:
+            with self._cond:
+                fill = not self._filled
+                self._filled = True
+            if fill:
+                try:
+                    self._fill()
+                except Exception:
+                    # e.g. MySQL is not up yet: let a later acquire() fill the pool again
+                    with self._cond:
+                        self._filled = False
+                    raise
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn = None
+        with self._cond:
+            self.acquires += 1
+            waited = False
+            while True:
+                if self._idle:
+                    conn, used_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.exhausted += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("timed out waiting for a database connection")
+                self._cond.wait(remaining)
+            elapsed = time.monotonic() - start
+            self.wait_seconds_total += elapsed
+            self.wait_seconds_max = max(self.wait_seconds_max, elapsed)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - used_at > self.ping_interval:
+                try:
+                    conn.ping()
+                except MySQLdb.Error:
+                    self._close(conn)
+                    conn = self._connect()
+                    with self._cond:
+                        self.reconnects += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except MySQLdb.Error:
+                self.discard(conn)
+                return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self.discards += 1
+            self._cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                min_size=self.min_size,
+                max_size=self.max_size,
+                acquires=self.acquires,
+                exhausted=self.exhausted,
+                timeouts=self.timeouts,
+                wait_seconds_total=self.wait_seconds_total,
+                wait_seconds_max=self.wait_seconds_max,
+                connects=self.connects,
+                reconnects=self.reconnects,
+                discards=self.discards,
+            )
+
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global _db_pool, _db_pool_pid
+    # a pool inherited through fork() shares sockets with the parent, so every process builds its own
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                _db_pool = ConnectionPool(
+                    dict(
+                        host=os.getenv('MYSQL_HOST', '127.0.0.1'),
+                        port=int(os.getenv('MYSQL_PORT', 3306)),
+                        user=os.getenv('MYSQL_USER', 'isucari'),
+                        password=os.getenv('MYSQL_PASS', 'isucari'),
+                        db=os.getenv('MYSQL_DBNAME', 'isucari'),
+                        charset='utf8mb4',
+                        cursorclass=DictCursor,
+                        autocommit=True,
+                        # rowcount reports matched rows, which is what the compare-and-set updates check
+                        client_flag=MySQLdb.constants.CLIENT.FOUND_ROWS,
+                    ),
+                    min_size=int(os.getenv('MYSQL_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.getenv('MYSQL_POOL_MAX_SIZE', 10)),
+                    timeout=float(os.getenv('MYSQL_POOL_TIMEOUT', 5)),
+                    ping_interval=float(os.getenv('MYSQL_POOL_PING_INTERVAL', 1)),
+                )
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
+
+debug_stats['db_pool'] = lambda: get_db_pool().stats()
+
+
 def dbh():
     if hasattr(flask.g, 'db'):
         return flask.g.db
 
-    flask.g.db = MySQLdb.connect(
-        host=os.getenv('MYSQL_HOST', '127.0.0.1'),
-        port=int(os.getenv('MYSQL_PORT', 3306)),
-        user=os.getenv('MYSQL_USER', 'isucari'),
-        password=os.getenv('MYSQL_PASS', 'isucari'),
-        db=os.getenv('MYSQL_DBNAME', 'isucari'),
-        charset='utf8mb4',
-        cursorclass=MySQLdb.cursors.DictCursor,
-        autocommit=True,
-    )
-    cur = flask.g.db.cursor()
-    cur.execute(
-        "SET SESSION sql_mode='STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION'")
+    flask.g.db = get_db_pool().acquire()
     return flask.g.db
 
 
+@app.teardown_appcontext
+def release_dbh(exc):
+    conn = flask.g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
+
 def http_json_error(code, msg):
     raise HttpException(code, msg)
 
@@ -92,6 +431,701 @@ def handle_http_exception(error):
     return error.get_response()
 
 
+def prometheus_labels(**labels):
+    return ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+    ) for name, value in labels.items())
+
+
+class RequestMetrics(object):
+    # per-route latency histograms served by /debug/metrics. Like /debug/stats.json, every process keeps
+    # its own and a scrape is answered by whichever gunicorn worker accepts it.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PHASES = ('db', 'http', 'json')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (name, method, route) -> per-bucket counts, the +Inf count and the sum
+        self._histograms = {}
+        self._responses = collections.Counter()
+        self._in_flight = collections.Counter()
+
+    def start(self, method, route):
+        self._local.request = [method, route, time.perf_counter(), 500]
+        self._local.phases = dict.fromkeys(self.PHASES, 0.0)
+        with self._lock:
+            self._in_flight[method, route] += 1
+
+    def set_status(self, status):
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request[3] = status
+
+    def add(self, phase, seconds):
+        # only the request's own thread is counted; waits on service_executor are timed by the caller
+        phases = getattr(self._local, 'phases', None)
+        if phases is not None:
+            phases[phase] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    def finish(self):
+        request = getattr(self._local, 'request', None)
+        if request is None:
+            return
+        phases = self._local.phases
+        self._local.request = self._local.phases = None
+
+        method, route, started, status = request
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._in_flight[method, route] -= 1
+            self._responses[method, route, status] += 1
+            self._observe(('request', method, route), elapsed)
+            for phase, seconds in phases.items():
+                self._observe((phase, method, route), seconds)
+
+    def _observe(self, key, seconds):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            histograms = sorted((key, list(histogram)) for key, histogram in self._histograms.items())
+            responses = sorted(self._responses.items())
+            in_flight = sorted(self._in_flight.items())
+
+        lines = [
+            '# HELP isucari_http_requests_in_flight Requests being handled right now.',
+            '# TYPE isucari_http_requests_in_flight gauge',
+        ]
+        for (method, route), value in in_flight:
+            lines.append('isucari_http_requests_in_flight{%s} %d' % (prometheus_labels(method=method, route=route), value))
+
+        lines += [
+            '# HELP isucari_http_responses_total Responses by status code.',
+            '# TYPE isucari_http_responses_total counter',
+        ]
+        for (method, route, status), value in responses:
+            lines.append('isucari_http_responses_total{%s} %d' % (
+                prometheus_labels(method=method, route=route, status=status), value))
+
+        for name, help_text, phases in (
+                ('isucari_http_request_duration_seconds', 'Time from routing to the end of the response.', ('request',)),
+                ('isucari_http_request_phase_seconds', 'Time per request spent waiting on MySQL (db), '
+                                                       'the external services (http) and encoding JSON (json).',
+                 self.PHASES),
+        ):
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+            for (phase, method, route), histogram in histograms:
+                if phase not in phases:
+                    continue
+                labels = dict(method=method, route=route)
+                if len(phases) > 1:
+                    labels = dict(phase=phase, **labels)
+                count = 0
+                for le, n in zip(self.BUCKETS + ('+Inf',), histogram):
+                    count += n
+                    lines.append('{}_bucket{{{}}} {}'.format(name, prometheus_labels(**labels, le=le), count))
+                lines.append('{}_sum{{{}}} {}'.format(name, prometheus_labels(**labels), histogram[-1]))
+                lines.append('{}_count{{{}}} {}'.format(name, prometheus_labels(**labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def request_route():
+    rule = flask.request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+@app.before_request
+def start_request_metrics():
+    request_metrics.start(flask.request.method, request_route())
+
+
+@app.after_request
+def record_response_status(res):
+    request_metrics.set_status(res.status_code)
+    return res
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # streamed responses (stream_with_context) are torn down after the last chunk is sent
+    request_metrics.finish()
+
+
+def redact_params(args):
+    # slow query logs show the shape of the parameters, never passwords, tokens or addresses
+    if args is None:
+        return []
+    if isinstance(args, dict):
+        return {name: type(value).__name__ for name, value in args.items()}
+    return [type(value).__name__ for value in args]
+
+
+class QueryStats(object):
+    # every statement run through DictCursor/SSDictCursor, grouped by normalized SQL. Statements issued by
+    # a request are also kept per request to count them and to spot the same shape running once per row.
+    # applied after LITERAL, so IN lists of any length, placeholders or values, share one shape
+    IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+    LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%s")
+    SPACES = re.compile(r'\s+')
+
+    def __init__(self, slow_seconds=0.1, repeat_threshold=10, log_requests=False):
+        self.slow_seconds = slow_seconds
+        self.repeat_threshold = repeat_threshold
+        self.log_requests = log_requests
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._normalized = {}
+        # normalized sql -> counters
+        self._shapes = {}
+        # route -> counters
+        self._routes = {}
+        # (route, normalized sql) -> requests that ran the shape repeat_threshold times or more
+        self._repeats = collections.Counter()
+        self.slow_queries = 0
+
+    def normalize(self, query):
+        normalized = self._normalized.get(query)
+        if normalized is None:
+            normalized = self.SPACES.sub(' ', query).strip()
+            normalized = self.IN_LIST.sub('IN (...)', self.LITERAL.sub('?', normalized))
+            if len(self._normalized) >= 4096:
+                self._normalized.clear()
+            self._normalized[query] = normalized
+        return normalized
+
+    def start(self, route):
+        self._local.route = route
+        self._local.queries = []
+
+    def record(self, query, args, seconds, rows):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        normalized = self.normalize(query)
+        rows = max(rows, 0)
+
+        queries = getattr(self._local, 'queries', None)
+        if queries is not None:
+            queries.append((normalized, seconds))
+
+        with self._lock:
+            shape = self._shapes.get(normalized)
+            if shape is None:
+                shape = self._shapes[normalized] = dict(calls=0, rows=0, seconds_total=0.0, seconds_max=0.0)
+            shape['calls'] += 1
+            shape['rows'] += rows
+            shape['seconds_total'] += seconds
+            shape['seconds_max'] = max(shape['seconds_max'], seconds)
+            if seconds >= self.slow_seconds:
+                self.slow_queries += 1
+
+        if seconds >= self.slow_seconds:
+            app.logger.warning("slow query on %s: %.1fms, %d rows: %s params=%s",
+                               getattr(self._local, 'route', None), seconds * 1000, rows, normalized,
+                               redact_params(args))
+
+    def finish(self):
+        queries = getattr(self._local, 'queries', None)
+        if queries is None:
+            return
+        route = self._local.route
+        self._local.queries = None
+
+        seconds = sum(elapsed for _, elapsed in queries)
+        repeated = [
+            (normalized, count) for normalized, count in collections.Counter(
+                normalized for normalized, _ in queries).items()
+            if count >= self.repeat_threshold
+        ]
+        with self._lock:
+            summary = self._routes.get(route)
+            if summary is None:
+                summary = self._routes[route] = dict(
+                    requests=0, queries_total=0, queries_max=0, seconds_total=0.0, seconds_max=0.0)
+            summary['requests'] += 1
+            summary['queries_total'] += len(queries)
+            summary['queries_max'] = max(summary['queries_max'], len(queries))
+            summary['seconds_total'] += seconds
+            summary['seconds_max'] = max(summary['seconds_max'], seconds)
+            for normalized, _ in repeated:
+                self._repeats[route, normalized] += 1
+
+        if self.log_requests:
+            app.logger.info("%s: %d queries, %.1fms in db", route, len(queries), seconds * 1000)
+        for normalized, count in repeated:
+            app.logger.warning("possible N+1 on %s: %d x %s", route, count, normalized)
+
+    def stats(self):
+        with self._lock:
+            shapes = sorted(self._shapes.items(), key=lambda shape: shape[1]['seconds_total'], reverse=True)
+            return dict(
+                slow_queries=self.slow_queries,
+                routes={route: dict(summary) for route, summary in self._routes.items()},
+                repeated=[
+                    dict(route=route, sql=normalized, requests=requests)
+                    for (route, normalized), requests in self._repeats.most_common()
+                ],
+                top_queries=[dict(sql=normalized, **shape) for normalized, shape in shapes[:50]],
+            )
+
+
+query_stats = QueryStats(
+    slow_seconds=float(os.getenv('SLOW_QUERY_SECONDS', 0.1)),
+    repeat_threshold=int(os.getenv('QUERY_REPEAT_THRESHOLD', 10)),
+    log_requests=os.getenv('QUERY_LOG') == '1',
+)
+if query_stats.log_requests:
+    app.logger.setLevel(logging.INFO)
+debug_stats['queries'] = query_stats.stats
+
+
+@app.before_request
+def start_query_stats():
+    query_stats.start(request_route())
+
+
+@app.teardown_request
+def finish_query_stats(exc):
+    query_stats.finish()
+
+
+class InvalidationBus(object):
+    # gunicorn runs several worker processes, each with its own caches. Writers publish the keys they
+    # changed into a ring buffer in a shared mmap'd file and every process replays it before using a cache.
+    HEADER = struct.Struct('<8sQ')
+    ENTRY = struct.Struct('<QQq')
+    MAGIC = b'isucari1'
+
+    CHANNEL_RESET = 0
+    CHANNEL_USER = 1
+    CHANNEL_ITEM = 2
+    CHANNEL_SHIPPING = 3
+    CHANNEL_PROFILE = 4
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        size = self.HEADER.size + self.ENTRY.size * capacity
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size or os.pread(self._fd, len(self.MAGIC), 0) != self.MAGIC:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, 0), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, size)
+
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(list)
+        self.cursor = self.seq()
+
+        self.published = 0
+        self.received = 0
+        self.overflows = 0
+
+    def seq(self):
+        return self.HEADER.unpack_from(self._mm, 0)[1]
+
+    def _offset(self, seq):
+        return self.HEADER.size + (seq - 1) % self.capacity * self.ENTRY.size
+
+    def subscribe(self, channel, callback):
+        self._subscribers[channel].append(callback)
+
+    def publish(self, channel, keys=(0,)):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                seq = self.seq()
+                for key in keys:
+                    seq += 1
+                    self.ENTRY.pack_into(self._mm, self._offset(seq), seq, channel, key)
+                self.HEADER.pack_into(self._mm, 0, self.MAGIC, seq)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.published += len(keys)
+        self.poll()
+
+    def poll(self):
+        if self.seq() == self.cursor:
+            return
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                seq = self.seq()
+                changes = collections.defaultdict(list)
+                if seq < self.cursor or seq - self.cursor > self.capacity:
+                    changes = None
+                else:
+                    for expected in range(self.cursor + 1, seq + 1):
+                        entry_seq, channel, key = self.ENTRY.unpack_from(self._mm, self._offset(expected))
+                        if entry_seq != expected:
+                            changes = None
+                            break
+                        changes[channel].append(key)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+            if changes is None:
+                self.overflows += 1
+            else:
+                self.received += seq - self.cursor
+            self.cursor = seq
+
+            if changes is None or self.CHANNEL_RESET in changes:
+                for callbacks in self._subscribers.values():
+                    for callback in callbacks:
+                        callback(None)
+            else:
+                for channel, keys in changes.items():
+                    for callback in self._subscribers.get(channel, ()):
+                        callback(keys)
+
+    def stats(self):
+        return dict(
+            path=self.path,
+            seq=self.seq(),
+            cursor=self.cursor,
+            published=self.published,
+            received=self.received,
+            overflows=self.overflows,
+        )
+
+
+_bus_subscriptions = []
+_bus = None
+_bus_pid = None
+_bus_lock = threading.Lock()
+
+
+def on_invalidate(channel):
+    def decorator(callback):
+        _bus_subscriptions.append((channel, callback))
+        return callback
+    return decorator
+
+
+def shm_path(name):
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(shm_dir, name)
+
+
+def get_invalidation_bus():
+    global _bus, _bus_pid
+    if _bus is None or _bus_pid != os.getpid():
+        with _bus_lock:
+            if _bus is None or _bus_pid != os.getpid():
+                bus = InvalidationBus(os.getenv('ISUCARI_BUS_PATH', shm_path('isucari-python.bus')))
+                for channel, callback in _bus_subscriptions:
+                    bus.subscribe(channel, callback)
+                _bus = bus
+                _bus_pid = os.getpid()
+    return _bus
+
+
+debug_stats['invalidation_bus'] = lambda: get_invalidation_bus().stats()
+
+
+@app.before_request
+def poll_invalidations():
+    get_invalidation_bus().poll()
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every invalidation; put() drops values loaded before one happened
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._data.get(key)
+                if value is None:
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(key)
+                self.hits += 1
+                found[key] = value
+        return found
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys=None):
+        with self._lock:
+            self.generation += 1
+            if keys is None:
+                self.invalidations += len(self._data)
+                self._data.clear()
+                return
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=len(self._data),
+                maxsize=self.maxsize,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+            )
+
+
+user_cache = LRUCache(int(os.getenv('USER_CACHE_SIZE', 10000)))
+on_invalidate(InvalidationBus.CHANNEL_USER)(user_cache.invalidate)
+debug_stats['user_cache'] = user_cache.stats
+
+
+class RouteProfiler(object):
+    # switched on at runtime by POST /debug/profile, which writes the settings to a file and tells every
+    # process through the invalidation bus. Matching requests run under cProfile while a background thread
+    # samples their stacks; both are aggregated per route and written out when profiling stops. The sampler
+    # also watches the file, so a worker that gets no requests still stops and writes its output.
+    # While it is off the request hooks only test a flag.
+
+    def __init__(self, config_path, output_dir, interval=0.005):
+        self.config_path = config_path
+        self.output_dir = output_dir
+        self.interval = interval
+
+        self.enabled = False
+        self.route = None
+        self.rate = 100.0
+        self.expires_at = 0.0
+        self.session = None
+
+        self._lock = threading.Lock()
+        # the bus callback and the sampler can both reload at once
+        self._reload_lock = threading.Lock()
+        self._generation = 0
+        # thread ident -> (route, cProfile.Profile or None, generation) for requests being profiled
+        self._active = {}
+        self._stats = {}
+        self._stacks = collections.defaultdict(collections.Counter)
+        self.requests = collections.Counter()
+        self.samples = 0
+
+    def configure(self, enabled, route=None, rate=100.0, seconds=60.0):
+        config = dict(
+            enabled=enabled,
+            route=route,
+            rate=rate,
+            expires_at=time.time() + seconds,
+            session=time.strftime('%Y%m%d-%H%M%S'),
+        )
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.config_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config, f)
+        os.replace(tmp, self.config_path)
+        get_invalidation_bus().publish(InvalidationBus.CHANNEL_PROFILE)
+
+    def config_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self, keys=None):
+        with self._reload_lock:
+            self._reload()
+
+    def _reload_from_sampler(self, generation):
+        # a sampler whose session was already replaced must not stop or restart its successor
+        with self._reload_lock:
+            if self._generation == generation:
+                self._reload()
+
+    def _reload(self):
+        mtime = self.config_mtime()
+        try:
+            with open(self.config_path) as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            config = {}
+
+        if not config.get('enabled') or config['expires_at'] <= time.time():
+            self.stop()
+            return
+        if self.enabled and self.session == config['session']:
+            return
+        self.stop()
+        with self._lock:
+            self.route = config['route']
+            self.rate = config['rate']
+            self.expires_at = config['expires_at']
+            self.session = config['session']
+            self._stats = {}
+            self._stacks = collections.defaultdict(collections.Counter)
+            self.requests.clear()
+            self.samples = 0
+            self._generation += 1
+            generation = self._generation
+            self.enabled = True
+        threading.Thread(target=self._sample, args=(generation, mtime), name='profile-sampler', daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            # requests still running drop their profiles in finish() once they see the new generation
+            self._generation += 1
+            stats, self._stats = self._stats, {}
+            stacks, self._stacks = self._stacks, collections.defaultdict(collections.Counter)
+
+        directory = pathlib.Path(self.output_dir) / self.session
+        directory.mkdir(parents=True, exist_ok=True)
+        for route, route_stats in stats.items():
+            route_stats.dump_stats(str(directory / '{}.{}.pstats'.format(self.file_name(route), os.getpid())))
+        for route, route_stacks in stacks.items():
+            with open(str(directory / '{}.{}.folded'.format(self.file_name(route), os.getpid())), 'w') as f:
+                for stack, count in route_stacks.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+
+    @staticmethod
+    def file_name(route):
+        return re.sub(r'[^0-9A-Za-z.]+', '_', route).strip('_') or 'index'
+
+    def start(self, route):
+        if self.route is not None and route != self.route:
+            return
+        if self.rate < 100 and random.random() * 100 >= self.rate:
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one cProfile per process at a time; the sampler still sees this request
+            profile = None
+        self._active[threading.get_ident()] = (route, profile, self._generation)
+
+    def finish(self):
+        if not self._active:
+            return
+        entry = self._active.pop(threading.get_ident(), None)
+        if entry is None:
+            return
+        route, profile, generation = entry
+        if profile is not None:
+            profile.disable()
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.requests[route] += 1
+            if profile is None:
+                return
+            stats = self._stats.get(route)
+            if stats is None:
+                self._stats[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def _sample(self, generation, mtime):
+        while self._generation == generation:
+            time.sleep(self.interval)
+            if time.time() >= self.expires_at:
+                self.stop()
+                return
+            if self.config_mtime() != mtime:
+                self._reload_from_sampler(generation)
+                return
+            frames = sys._current_frames()
+            for ident, (route, _, active_generation) in list(self._active.items()):
+                if active_generation != generation:
+                    continue
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                with self._lock:
+                    self._stacks[route][';'.join(reversed(stack))] += 1
+                    self.samples += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                enabled=self.enabled,
+                route=self.route,
+                rate=self.rate,
+                session=self.session,
+                expires_in=max(self.expires_at - time.time(), 0) if self.enabled else 0,
+                output_dir=self.output_dir,
+                requests=dict(self.requests),
+                samples=self.samples,
+            )
+
+
+profiler = RouteProfiler(
+    os.getenv('ISUCARI_PROFILE_PATH', shm_path('isucari-python.profile')),
+    os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'isucari-profile')),
+    interval=float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005)),
+)
+on_invalidate(InvalidationBus.CHANNEL_PROFILE)(profiler.reload)
+debug_stats['profiler'] = profiler.stats
+
+
+@app.before_request
+def start_profile():
+    if profiler.enabled:
+        profiler.start(request_route())
+
+
+@app.teardown_request
+def finish_profile(exc):
+    profiler.finish()
+
+
+def ensure_local_request():
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        http_json_error(requests.codes['not_found'], "not found")
+
+
 def random_string(length):
     letters = string.ascii_lowercase + string.digits
     return ''.join(random.choice(letters) for _ in range(length))
@@ -133,38 +1167,113 @@ def get_user_or_none():
     return user
 
 
+def get_user_simples_by_ids(user_ids):
+    # request scoped identity map: every row of a page shares the same user dict
+    users = flask.g.setdefault('user_simples', {})
+    missing = {user_id for user_id in user_ids if user_id not in users}
+    if not missing:
+        return users
+
+    generation = user_cache.generation
+    cached = user_cache.get_many(missing)
+    users.update(cached)
+    missing.difference_update(cached)
+    if missing:
+        try:
+            conn = dbh()
+            with conn.cursor() as c:
+                sql = "SELECT `id`, `account_name`, `num_sell_items` FROM `users` WHERE `id` IN (" + ",".join(["%s"] * len(missing)) + ")"
+                c.execute(sql, list(missing))
+                rows = c.fetchall()
+        except MySQLdb.Error as err:
+            app.logger.exception(err)
+            http_json_error(requests.codes['internal_server_error'], "db error")
+
+        get_invalidation_bus().poll()
+        for user in rows:
+            users[user['id']] = user
+            user_cache.put(user['id'], user, generation)
+    return users
+
+
 def get_user_simple_by_id(user_id):
     try:
-        conn = dbh()
-        with conn.cursor() as c:
-            sql = "SELECT * FROM `users` WHERE `id` = %s"
-            c.execute(sql, [user_id])
-            user = c.fetchone()
-            if user is None:
-                http_json_error(requests.codes['not_found'], "user not found")
-    except MySQLdb.Error as err:
-        app.logger.exception(err)
-        http_json_error(requests.codes['internal_server_error'], "db error")
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        http_json_error(requests.codes['not_found'], "user not found")
+    user = get_user_simples_by_ids([user_id]).get(user_id)
+    if user is None:
+        http_json_error(requests.codes['not_found'], "user not found")
     return user
 
 
-def get_category_by_id(category_id):
+class CategoryTree(object):
+    # categories is static seed data, so it is loaded once and shared by every request
+
+    def __init__(self, rows):
+        self.rows = [dict(row) for row in rows]
+        self.categories = {}
+        self.children = {}
+
+        names = {row['id']: row['category_name'] for row in self.rows}
+        for row in self.rows:
+            category = dict(row)
+            if category['parent_id'] != 0:
+                if category['parent_id'] in names:
+                    category['parent_category_name'] = names[category['parent_id']]
+                self.children.setdefault(category['parent_id'], []).append(category['id'])
+            self.categories[category['id']] = category
+
+        self.children = {k: tuple(v) for k, v in self.children.items()}
+
+    def get(self, category_id):
+        return self.categories.get(category_id)
+
+    def child_ids(self, root_category_id):
+        return self.children.get(root_category_id, ())
+
+
+_category_tree = None
+_category_tree_lock = threading.Lock()
+
+
+def load_category_tree():
+    global _category_tree
     conn = dbh()
-    sql = "SELECT * FROM `categories` WHERE `id` = %s"
     with conn.cursor() as c:
-        c.execute(sql, (category_id,))
-        category = c.fetchone()
-        # TODO: check err
-    if category['parent_id'] != 0:
-        parent = get_category_by_id(category['parent_id'])
-        if parent is not None:
-            category['parent_category_name'] = parent['category_name']
-    return category
+        c.execute("SELECT * FROM `categories` ORDER BY `id`")
+        tree = CategoryTree(c.fetchall())
+    _category_tree = tree
+    return tree
+
+
+def get_category_tree():
+    # a concurrent reset can clear the global at any point, so only ever hand out a local reference
+    tree = _category_tree
+    if tree is None:
+        with _category_tree_lock:
+            tree = _category_tree
+            if tree is None:
+                tree = load_category_tree()
+    return tree
+
+
+@on_invalidate(InvalidationBus.CHANNEL_RESET)
+def reset_category_tree(keys):
+    global _category_tree
+    _category_tree = None
+
+
+def get_category_by_id(category_id):
+    try:
+        category_id = int(category_id)
+    except (TypeError, ValueError):
+        return None
+    return get_category_tree().get(category_id)
 
 
 def to_user_json(user):
-    del (user['hashed_password'], user['last_bump'], user['created_at'])
-    return user
+    return {k: v for k, v in user.items() if k not in ('hashed_password', 'last_bump', 'created_at')}
 
 
 def to_item_json(item, simple=False):
@@ -183,6 +1292,22 @@ def to_item_json(item, simple=False):
     return {k:v for k,v in item.items() if k in keys}
 
 
+def to_item_jsons(items, simple=False):
+    users = get_user_simples_by_ids([item["seller_id"] for item in items])
+
+    item_jsons = []
+    for item in items:
+        seller = users.get(item["seller_id"])
+        if seller is None:
+            http_json_error(requests.codes['not_found'], "user not found")
+
+        item["category"] = get_category_by_id(item["category_id"])
+        item["seller"] = to_user_json(seller)
+        item["image_url"] = get_image_url(item["image_name"])
+        item_jsons.append(to_item_json(item, simple=simple))
+    return item_jsons
+
+
 def ensure_required_payload(keys=None):
     if keys is None:
         keys = []
@@ -196,13 +1321,46 @@ def ensure_valid_csrf_token():
         http_json_error(requests.codes['unprocessable_entity'], "csrf token error")
 
 
+class ConfigCache(object):
+    # configs is only written by /initialize, which repopulates this cache and resets the other workers
+
+    def __init__(self):
+        self._configs = None
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def load(self):
+        conn = dbh()
+        with conn.cursor() as c:
+            c.execute("SELECT * FROM `configs`")
+            return {config['name']: config for config in c.fetchall()}
+
+    def get(self, name):
+        configs = self._configs
+        if configs is None:
+            generation = self.generation
+            configs = self.load()
+            get_invalidation_bus().poll()
+            self.populate(configs, generation)
+        return configs.get(name)
+
+    def populate(self, configs, generation=None):
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._configs = configs
+
+    def invalidate(self, keys=None):
+        with self._lock:
+            self.generation += 1
+            self._configs = None
+
+
+config_cache = ConfigCache()
+on_invalidate(InvalidationBus.CHANNEL_RESET)(config_cache.invalidate)
+
+
 def get_config(name):
-    conn = dbh()
-    sql = "SELECT * FROM `configs` WHERE `name` = %s"
-    with conn.cursor() as c:
-        c.execute(sql, (name,))
-        config = c.fetchone()
-    return config
+    return config_cache.get(name)
 
 
 def get_payment_service_url():
@@ -215,31 +1373,761 @@ def get_shipment_service_url():
     return Constants.DEFAULT_SHIPMENT_SERVICE_URL if config is None else config['val']
 
 
+class ServiceClient(object):
+
+    def __init__(self, pool_maxsize=32, connect_timeout=1.0, read_timeout=5.0):
+        self.timeout = (connect_timeout, read_timeout)
+        # urllib3 keeps one keep-alive pool per host and hands connections out thread-safely
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def post(self, url, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.monotonic()
+        failed = True
+        try:
+            res = self._session.post(url + path, **kwargs)
+            res.raise_for_status()
+            failed = False
+            return res
+        finally:
+            elapsed = time.monotonic() - started
+            self._record(path, elapsed, failed)
+            request_metrics.add('http', elapsed)
+
+    def _record(self, path, seconds, failed):
+        with self._lock:
+            endpoint = self._endpoints.get(path)
+            if endpoint is None:
+                endpoint = self._endpoints[path] = dict(
+                    requests=0, errors=0, seconds_total=0.0, seconds_max=0.0)
+            endpoint['requests'] += 1
+            endpoint['errors'] += failed
+            endpoint['seconds_total'] += seconds
+            endpoint['seconds_max'] = max(endpoint['seconds_max'], seconds)
+
+    def stats(self):
+        with self._lock:
+            return {path: dict(endpoint) for path, endpoint in self._endpoints.items()}
+
+
+_service_client = None
+_service_client_pid = None
+_service_client_lock = threading.Lock()
+
+
+def get_service_client():
+    global _service_client, _service_client_pid
+    # like the db pool, sockets must not be shared with a forked parent
+    if _service_client is None or _service_client_pid != os.getpid():
+        with _service_client_lock:
+            if _service_client is None or _service_client_pid != os.getpid():
+                _service_client = ServiceClient(
+                    pool_maxsize=int(os.getenv('SERVICE_CLIENT_POOL_SIZE', 32)),
+                    connect_timeout=float(os.getenv('SERVICE_CLIENT_CONNECT_TIMEOUT', 1)),
+                    read_timeout=float(os.getenv('SERVICE_CLIENT_READ_TIMEOUT', 5)),
+                )
+                _service_client_pid = os.getpid()
+    return _service_client
+
+
+debug_stats['service_client'] = lambda: get_service_client().stats()
+
+
 def api_shipment_status(shipment_url, params={}):
 
     try:
-        res = requests.post(
-            shipment_url + "/status",
+        res = get_service_client().post(
+            shipment_url, "/status",
             headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
             json=params,
         )
-        res.raise_for_status()
-    except (socket.gaierror, requests.HTTPError) as err:
+    except (socket.gaierror, requests.RequestException) as err:
         app.logger.exception(err)
-        http_json_error(requests.codes['internal_server_error'])
+        http_json_error(requests.codes['internal_server_error'], "failed to request to shipment service")
 
     return res.json()
 
 
+# runs the external calls a single request can overlap: status fan-out and /buy's /create + /token
+service_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('SERVICE_CALL_CONCURRENCY', 16)),
+    thread_name_prefix='service-call',
+)
+
+
+def api_shipment_statuses(shipment_url, reserve_ids):
+    # one page of /users/transactions.json asks for up to TRANSACTIONS_PER_PAGE statuses at once
+    futures = {
+        reserve_id: service_executor.submit(api_shipment_status, shipment_url, {"reserve_id": reserve_id})
+        for reserve_id in set(reserve_ids)
+    }
+    with request_metrics.timer('http'):
+        _, not_done = concurrent.futures.wait(
+            futures.values(), timeout=float(os.getenv('SHIPMENT_STATUS_DEADLINE', 5)))
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        app.logger.error("shipment status deadline exceeded for %d of %d requests", len(not_done), len(futures))
+        http_json_error(requests.codes['internal_server_error'], "failed to request to shipment service")
+
+    return {reserve_id: future.result() for reserve_id, future in futures.items()}
+
+
+# keyed by transaction_evidence_id, values are (status, expires_at)
+shipment_status_cache = LRUCache(int(os.getenv('SHIPMENT_STATUS_CACHE_SIZE', 20000)))
+SHIPMENT_STATUS_TTL = float(os.getenv('SHIPMENT_STATUS_TTL', 0.5))
+
+on_invalidate(InvalidationBus.CHANNEL_SHIPPING)(shipment_status_cache.invalidate)
+debug_stats['shipment_status_cache'] = shipment_status_cache.stats
+
+
+def known_shipping_statuses(shippings):
+    # the statuses that need no shipment service call, plus {transaction_evidence_id: reserve_id} for the
+    # rest and the cache generation to store their answers under. Shared with asgi.py.
+    statuses = {}
+    pending = {}
+    for shipping in shippings:
+        # done is terminal so the row already has the answer; every other state, initial included, can
+        # move on in the shipment service before the row catches up (post_ship calls /request first).
+        # An empty reserve_id is a purchase still waiting for /create, which the service knows nothing of.
+        if shipping["status"] == Constants.SHIPPING_STATUS_DONE or not shipping["reserve_id"]:
+            statuses[shipping["transaction_evidence_id"]] = shipping["status"]
+        else:
+            pending[shipping["transaction_evidence_id"]] = shipping["reserve_id"]
+
+    generation = shipment_status_cache.generation
+    if pending:
+        now = time.monotonic()
+        for transaction_evidence_id, (status, expires_at) in shipment_status_cache.get_many(pending).items():
+            if expires_at > now:
+                statuses[transaction_evidence_id] = status
+                del pending[transaction_evidence_id]
+    return statuses, pending, generation
+
+
+def record_shipping_statuses(statuses, pending, ssrs, generation):
+    # adds the shipment service's answers to statuses and caches them; returns the transactions that
+    # reached done, for the caller to write back so they are never asked for again
+    done = []
+    get_invalidation_bus().poll()
+    expires_at = time.monotonic() + SHIPMENT_STATUS_TTL
+    for transaction_evidence_id, reserve_id in pending.items():
+        status = ssrs[reserve_id]["status"]
+        statuses[transaction_evidence_id] = status
+        if status == Constants.SHIPPING_STATUS_DONE:
+            done.append(transaction_evidence_id)
+        else:
+            shipment_status_cache.put(transaction_evidence_id, (status, expires_at), generation)
+    return done
+
+
+def get_shipping_statuses(shippings):
+    statuses, pending, generation = known_shipping_statuses(shippings)
+    if not pending:
+        return statuses
+
+    ssrs = api_shipment_statuses(get_shipment_service_url(), pending.values())
+    done = record_shipping_statuses(statuses, pending, ssrs, generation)
+    if done:
+        with dbh().cursor() as c:
+            c.execute(*Queries.shippings_done(done))
+    return statuses
+
+
+def add_transaction_fields(item, transaction_evidence, shipping_statuses):
+    item["transaction_evidence_id"] = transaction_evidence["id"]
+    item["transaction_evidence_status"] = transaction_evidence["status"]
+    item["shipping_status"] = shipping_statuses[transaction_evidence["id"]]
+
+
+def get_shipment_status(shipping):
+    # the write paths act on the answer, so they skip the cache and only trust the row when it is terminal
+    if shipping["status"] == Constants.SHIPPING_STATUS_DONE:
+        return shipping["status"]
+    return api_shipment_status(get_shipment_service_url(), {"reserve_id": shipping["reserve_id"]})["status"]
+
+
+class TimelineIndex(object):
+    # keys are (-created_at, -id) so ascending order is the listing order and bisect works directly
+
+    def __init__(self, keys=()):
+        self._keys = sorted(keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        bisect.insort(self._keys, key)
+
+    def discard(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def page(self, created_at, item_id, limit):
+        start = 0
+        if item_id > 0 and created_at > 0:
+            # created_at < ? OR (created_at <= ? AND id < ?)
+            start = bisect.bisect_right(self._keys, (-created_at, -item_id))
+        return [-key[1] for key in self._keys[start:start + limit]]
+
+
+class ItemTimelines(object):
+    # MySQL stays the source of truth: writers publish changed item ids on the invalidation bus and
+    # every process reloads just those rows before answering the next page
+
+    STATUSES = (Constants.ITEM_STATUS_ON_SALE, Constants.ITEM_STATUS_SOLD_OUT)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = set()
+        self._stale = True
+
+        self._keys = {}
+        self.all = TimelineIndex()
+        self.by_root = {}
+
+        self.hits = 0
+        self.fallbacks = 0
+        self.rebuilds = 0
+        self.reloads = 0
+
+    @staticmethod
+    def key(item):
+        return (-int(item['created_at'].timestamp()), -item['id'])
+
+    @staticmethod
+    def root_category_id(item):
+        category = get_category_by_id(item['category_id'])
+        if category is None or category['parent_id'] == 0:
+            return item['category_id']
+        return category['parent_id']
+
+    def invalidate(self, item_ids=None):
+        with self._pending_lock:
+            if item_ids is None:
+                self._stale = True
+                self._pending.clear()
+            else:
+                self._pending.update(item_ids)
+
+    def sync(self):
+        if not self._stale and not self._pending:
+            return
+        with self._lock:
+            with self._pending_lock:
+                stale, self._stale = self._stale, False
+                item_ids, self._pending = self._pending, set()
+            try:
+                if stale:
+                    self._rebuild()
+                elif item_ids:
+                    self._reload(item_ids)
+            except MySQLdb.Error:
+                self.invalidate(None if stale else item_ids)
+                raise
+
+    def _rebuild(self):
+        conn = dbh()
+        with conn.cursor() as c:
+            sql = "SELECT `id`, `status`, `category_id`, `created_at` FROM `items` WHERE `status` IN (%s,%s)"
+            c.execute(sql, self.STATUSES)
+            keys = {item['id']: (self.key(item), self.root_category_id(item)) for item in c.fetchall()}
+
+        root_keys = collections.defaultdict(list)
+        for key, root_category_id in keys.values():
+            root_keys[root_category_id].append(key)
+
+        self._keys = keys
+        self.all = TimelineIndex(key for key, _ in keys.values())
+        self.by_root = {root_category_id: TimelineIndex(k) for root_category_id, k in root_keys.items()}
+        self.rebuilds += 1
+
+    def _reload(self, item_ids):
+        conn = dbh()
+        with conn.cursor() as c:
+            sql = "SELECT `id`, `status`, `category_id`, `created_at` FROM `items` WHERE `id` IN (" + ",".join(["%s"] * len(item_ids)) + ")"
+            c.execute(sql, list(item_ids))
+            items = {item['id']: item for item in c.fetchall()}
+        for item_id in item_ids:
+            entry = self._keys.pop(item_id, None)
+            if entry is not None:
+                key, root_category_id = entry
+                self.all.discard(key)
+                self.by_root[root_category_id].discard(key)
+
+            item = items.get(item_id)
+            if item is not None and item['status'] in self.STATUSES:
+                key, root_category_id = self.key(item), self.root_category_id(item)
+                self._keys[item_id] = (key, root_category_id)
+                self.all.add(key)
+                self.by_root.setdefault(root_category_id, TimelineIndex()).add(key)
+        self.reloads += len(item_ids)
+
+    def page(self, created_at, item_id, limit, root_category_id=None):
+        self.sync()
+        with self._lock:
+            if root_category_id is None:
+                index = self.all
+            else:
+                index = self.by_root.get(root_category_id, TimelineIndex())
+            return index.page(created_at, item_id, limit)
+
+    def load_items(self, item_ids):
+        items = get_items_by_ids(item_ids)
+        stale = [
+            i for i in item_ids
+            if i not in items or items[i]['status'] not in self.STATUSES
+            or (self.key(items[i]), self.root_category_id(items[i])) != self._keys.get(i)
+        ]
+        if stale:
+            # the index raced a write; repair it and let the caller answer from MySQL this time
+            self.invalidate(stale)
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        return items
+
+    def cursor_of(self, item_id):
+        # the (created_at, item_id) paging parameters that continue after item_id
+        key, _ = self._keys[item_id]
+        return -key[0], -key[1]
+
+    def stats(self):
+        return dict(
+            size=len(self.all),
+            pending=len(self._pending),
+            stale=self._stale,
+            hits=self.hits,
+            fallbacks=self.fallbacks,
+            rebuilds=self.rebuilds,
+            reloads=self.reloads,
+        )
+
+
+item_timelines = ItemTimelines()
+on_invalidate(InvalidationBus.CHANNEL_ITEM)(item_timelines.invalidate)
+on_invalidate(InvalidationBus.CHANNEL_RESET)(item_timelines.invalidate)
+debug_stats['timeline'] = item_timelines.stats
+
+
+item_fragments = LRUCache(int(os.getenv('ITEM_FRAGMENT_CACHE_SIZE', 20000)))
+on_invalidate(InvalidationBus.CHANNEL_ITEM)(item_fragments.invalidate)
+on_invalidate(InvalidationBus.CHANNEL_RESET)(item_fragments.invalidate)
+debug_stats['item_fragments'] = item_fragments.stats
+
+
+def get_item_fragments(item_ids, load, generation=None):
+    # encoded simple item json without the seller, which is spliced in by render_item_simples. Callers
+    # that already selected the rows pass the generation they read before that SELECT, so an
+    # invalidation in between keeps their rows out of the cache.
+    if generation is None:
+        generation = item_fragments.generation
+    fragments = item_fragments.get_many(item_ids)
+    missing = [item_id for item_id in item_ids if item_id not in fragments]
+    if missing:
+        items = load(missing)
+        if items is None:
+            return None
+
+        get_invalidation_bus().poll()
+        for item_id in missing:
+            item = dict(items[item_id])
+            item["category"] = get_category_by_id(item["category_id"])
+            item["image_url"] = get_image_url(item["image_name"])
+            fragment = (item["seller_id"], json_bytes(to_item_json(item, simple=True)))
+            item_fragments.put(item_id, fragment, generation)
+            fragments[item_id] = fragment
+    return [fragments[item_id] for item_id in item_ids]
+
+
+def render_item_simples(fragments):
+    users = get_user_simples_by_ids([seller_id for seller_id, _ in fragments])
+    sellers = {}
+    parts = []
+    for seller_id, fragment in fragments:
+        if seller_id not in sellers:
+            seller = users.get(seller_id)
+            if seller is None:
+                http_json_error(requests.codes['not_found'], "user not found")
+            sellers[seller_id] = json_bytes(to_user_json(seller))
+        parts.append(b'{"seller":' + sellers[seller_id] + b',' + fragment[1:])
+    return b'[' + b','.join(parts) + b']'
+
+
+def get_items_by_ids(item_ids):
+    if not item_ids:
+        return {}
+    conn = dbh()
+    with conn.cursor() as c:
+        sql = "SELECT * FROM `items` WHERE `id` IN (" + ",".join(["%s"] * len(item_ids)) + ")"
+        c.execute(sql, list(item_ids))
+        return {item['id']: item for item in c.fetchall()}
+
+
+MIGRATIONS_DIR = pathlib.Path(__file__).resolve().parent / 'migrations'
+
+
+# tables only the Python implementation has; init.sh loads the schema shared by every language and
+# leaves them behind, so the Python reset drops them and the migrations recreate them
+PYTHON_TABLES = ('schema_migrations', 'shipping_images')
+
+
+def drop_python_tables(conn):
+    with conn.cursor() as c:
+        for table in PYTHON_TABLES:
+            c.execute("DROP TABLE IF EXISTS `{}`".format(table))
+
+
+def run_migrations(conn):
+    applied = []
+    with conn.cursor() as c:
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS `schema_migrations` ("
+            "`version` varchar(191) NOT NULL PRIMARY KEY, "
+            "`applied_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP"
+            ") ENGINE=InnoDB DEFAULT CHARACTER SET utf8mb4")
+        c.execute("SELECT `version` FROM `schema_migrations`")
+        versions = {row['version'] for row in c.fetchall()}
+
+        for path in sorted(MIGRATIONS_DIR.glob('*.sql')):
+            if path.stem in versions:
+                continue
+            lines = [line for line in path.read_text().splitlines() if not line.lstrip().startswith('--')]
+            for statement in "\n".join(lines).split(';'):
+                if statement.strip():
+                    c.execute(statement)
+            c.execute("INSERT INTO `schema_migrations` (`version`) VALUES (%s)", (path.stem,))
+            applied.append(path.stem)
+    return applied
+
+
+# an ordered index scan that stops at the LIMIT is the plan the listing queries are built for; EXPLAIN's
+# rows estimate tells it apart from one that walks the whole index to fill a page
+EXPLAIN_MAX_ROWS = int(os.getenv('EXPLAIN_MAX_ROWS', 1000))
+
+
+def explain_listing_queries(conn):
+    now = int(time.time())
+    with conn.cursor() as c:
+        c.execute("SELECT `id` FROM `categories` WHERE `parent_id` = (SELECT MIN(`id`) FROM `categories` WHERE `parent_id` = 0)")
+        category_ids = [row['id'] for row in c.fetchall()]
+
+        shapes = [
+            ("new_items", *Queries.new_items(0, 0)),
+            ("new_items paging", *Queries.new_items(now, 1000)),
+            ("category items", *Queries.category_items(category_ids, 0, 0)),
+            ("category items paging", *Queries.category_items(category_ids, now, 1000)),
+            ("transactions", *Queries.transactions(1, 0, 0)),
+            ("transactions paging", *Queries.transactions(1, now, 1000)),
+            ("user items", *Queries.user_items(1, 0, 0)),
+            ("user items paging", *Queries.user_items(1, now, 1000)),
+        ]
+
+        problems = []
+        for name, sql, params in shapes:
+            c.execute("EXPLAIN " + sql, params)
+            for row in c.fetchall():
+                # the UNION RESULT row only concatenates the already limited branches
+                if row['select_type'] == 'UNION RESULT':
+                    continue
+                rows = row['rows'] or 0
+                if row['type'] == 'ALL':
+                    problems.append("{}: full scan on {}".format(name, row['table']))
+                elif row['type'] == 'index' and rows > EXPLAIN_MAX_ROWS:
+                    problems.append("{}: full index scan of {} on {}, ~{} rows".format(
+                        name, row['key'], row['table'], rows))
+                elif rows > EXPLAIN_MAX_ROWS:
+                    problems.append("{}: ~{} rows examined on {}".format(name, rows, row['table']))
+                if 'Using filesort' in (row['Extra'] or ''):
+                    problems.append("{}: filesort on {}".format(name, row['table']))
+    return problems
+
+
+SQL_DIR = base_path / 'sql'
+RESET_MODE = os.getenv('ISUCARI_RESET_MODE', 'snapshot')
+
+
+def snapshot_fingerprint():
+    # the snapshot is only valid for the exact schema, seed data and migrations it was taken from
+    digest = hashlib.sha256()
+    try:
+        for path in (SQL_DIR / '01_schema.sql', SQL_DIR / '02_categories.sql', *sorted(MIGRATIONS_DIR.glob('*.sql'))):
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+        stat = (SQL_DIR / 'initial.sql').stat()
+    except OSError as err:
+        # e.g. initial.sql not generated yet: no snapshot can match, so reset the slow way
+        app.logger.warning("snapshot disabled: %s", err)
+        return None
+    digest.update("initial.sql:{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def show_tables(c):
+    c.execute("SHOW TABLES")
+    return [next(iter(row.values())) for row in c.fetchall()]
+
+
+def take_snapshot(conn):
+    # copies every table as `snapshot_<name>`; 01_schema.sql only drops the tables it creates,
+    # so the copies survive init.sh and restore_snapshot() can swap them back in
+    fingerprint = snapshot_fingerprint()
+    if fingerprint is None:
+        return None
+    with conn.cursor() as c:
+        tables = [table for table in show_tables(c) if not table.startswith(('snapshot_', 'restore_', 'trash_'))]
+        c.execute("DROP TABLE IF EXISTS `snapshot_meta`")
+        for table in tables:
+            c.execute("DROP TABLE IF EXISTS `snapshot_{0}`".format(table))
+            c.execute("CREATE TABLE `snapshot_{0}` LIKE `{0}`".format(table))
+            c.execute("INSERT INTO `snapshot_{0}` SELECT * FROM `{0}`".format(table))
+        c.execute(
+            "CREATE TABLE `snapshot_meta` ("
+            "`table_name` varchar(191) NOT NULL PRIMARY KEY, "
+            "`fingerprint` char(64) NOT NULL"
+            ") ENGINE=InnoDB DEFAULT CHARACTER SET utf8mb4")
+        c.executemany(
+            "INSERT INTO `snapshot_meta` (`table_name`, `fingerprint`) VALUES (%s, %s)",
+            [(table, fingerprint) for table in tables])
+    return tables
+
+
+def restore_snapshot(conn):
+    with conn.cursor() as c:
+        existing = show_tables(c)
+        fingerprint = snapshot_fingerprint()
+        if fingerprint is None:
+            return None
+        tables = []
+        if 'snapshot_meta' in existing:
+            c.execute("SELECT `table_name` FROM `snapshot_meta` WHERE `fingerprint` = %s", (fingerprint,))
+            tables = [row['table_name'] for row in c.fetchall()]
+        if not tables or any('snapshot_' + table not in existing for table in tables):
+            app.logger.warning("no snapshot of the current schema, seed data and migrations; run snapshot.py")
+            return None
+
+        # build full copies next to the live tables, then swap all of them in with one atomic RENAME
+        for table in tables:
+            c.execute("DROP TABLE IF EXISTS `restore_{0}`".format(table))
+            c.execute("DROP TABLE IF EXISTS `trash_{0}`".format(table))
+            c.execute("CREATE TABLE `restore_{0}` LIKE `snapshot_{0}`".format(table))
+            c.execute("INSERT INTO `restore_{0}` SELECT * FROM `snapshot_{0}`".format(table))
+        renames = []
+        for table in tables:
+            if table in existing:
+                renames.append("`{0}` TO `trash_{0}`".format(table))
+            renames.append("`restore_{0}` TO `{0}`".format(table))
+        c.execute("RENAME TABLE " + ", ".join(renames))
+        for table in tables:
+            c.execute("DROP TABLE IF EXISTS `trash_{0}`".format(table))
+    return tables
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - started
+
+    def server_timing(self):
+        return ", ".join("{};dur={:.1f}".format(name, seconds * 1000) for name, seconds in self.phases.items())
+
+
+last_initialize = {}
+debug_stats['initialize'] = lambda: dict(last_initialize)
+
+
+# the benchmarker gives /initialize 20 seconds; warm-up stops early enough to leave a margin
+INITIALIZE_DEADLINE = float(os.getenv('INITIALIZE_DEADLINE', 15))
+WARMUP_BUDGET = float(os.getenv('WARMUP_BUDGET', 5))
+WARMUP_PAGES = int(os.getenv('WARMUP_PAGES', 2))
+WARMUP_USERS = int(os.getenv('WARMUP_USERS', 2000))
+WARMUP_INDEXES = (
+    ('items', 'PRIMARY'),
+    ('items', 'idx_created_at'),
+    ('items', 'idx_seller_id_created_at'),
+    ('items', 'idx_buyer_id_created_at'),
+    ('users', 'PRIMARY'),
+    ('transaction_evidences', 'PRIMARY'),
+    ('transaction_evidences', 'item_id'),
+    ('shippings', 'PRIMARY'),
+)
+
+
+def warm_categories(deadline):
+    return len(load_category_tree().categories)
+
+
+def warm_timelines(deadline):
+    item_timelines.sync()
+    return len(item_timelines.all)
+
+
+def warm_timeline_pages(deadline, root_category_id=None):
+    created_at, item_id, pages = 0, 0, 0
+    while pages < WARMUP_PAGES and time.monotonic() < deadline:
+        item_ids = item_timelines.page(created_at, item_id, Constants.ITEMS_PER_PAGE + 1, root_category_id)
+        fragments = get_item_fragments(item_ids[:Constants.ITEMS_PER_PAGE], item_timelines.load_items)
+        if fragments is None:
+            break
+        # also pulls the sellers of the page into user_cache
+        render_item_simples(fragments)
+        pages += 1
+        if len(item_ids) <= Constants.ITEMS_PER_PAGE:
+            break
+        created_at, item_id = item_timelines.cursor_of(item_ids[Constants.ITEMS_PER_PAGE - 1])
+    return pages
+
+
+def warm_new_items(deadline):
+    return warm_timeline_pages(deadline)
+
+
+def warm_category_items(deadline):
+    pages = 0
+    for category in get_category_tree().rows:
+        if category['parent_id'] == 0 and time.monotonic() < deadline:
+            pages += warm_timeline_pages(deadline, category['id'])
+    return pages
+
+
+def warm_users(deadline):
+    generation = user_cache.generation
+    with dbh().cursor() as c:
+        sql = "SELECT `id`, `account_name`, `num_sell_items` FROM `users` ORDER BY `num_sell_items` DESC LIMIT %s"
+        c.execute(sql, (WARMUP_USERS,))
+        users = c.fetchall()
+    for user in users:
+        user_cache.put(user['id'], user, generation)
+    return len(users)
+
+
+def warm_indexes(deadline):
+    # walking each index once pulls its pages into the InnoDB buffer pool, which every worker shares;
+    # MAX_EXECUTION_TIME keeps a cold disk from running past the budget
+    warmed = []
+    with dbh().cursor() as c:
+        for table, index in WARMUP_INDEXES:
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                break
+            sql = "SELECT /*+ MAX_EXECUTION_TIME({}) */ COUNT(*) AS `cnt` FROM `{}` FORCE INDEX (`{}`)".format(
+                remaining_ms, table, index)
+            c.execute(sql)
+            warmed.append("{}.{}".format(table, index))
+    return warmed
+
+
+WARMUP_STEPS = (
+    ('categories', warm_categories),
+    ('timelines', warm_timelines),
+    ('new_items', warm_new_items),
+    ('category_items', warm_category_items),
+    ('users', warm_users),
+    ('indexes', warm_indexes),
+)
+
+
+def warm_up(deadline):
+    # the caches filled here are those of the worker serving /initialize; the others fill theirs on
+    # demand, but they all find the same data already in the buffer pool
+    report = collections.OrderedDict()
+    for name, step in WARMUP_STEPS:
+        if time.monotonic() >= deadline:
+            report[name] = dict(skipped=True)
+            continue
+        started = time.monotonic()
+        try:
+            warmed = step(deadline)
+        except (MySQLdb.Error, HttpException) as err:
+            app.logger.warning("warm-up %s: %s", name, err)
+            report[name] = dict(error=str(err), seconds=time.monotonic() - started)
+            continue
+        report[name] = dict(warmed=warmed, seconds=time.monotonic() - started)
+    return report
+
+
+def json_bytes(obj):
+    started = time.perf_counter()
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    finally:
+        request_metrics.add('json', time.perf_counter() - started)
+
+
+def jsonify(*args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return flask.jsonify(*args, **kwargs)
+    finally:
+        request_metrics.add('json', time.perf_counter() - started)
+
+
+def jsonify_items(items_json, **fields):
+    body = b'{"items":' + items_json + b',' + json_bytes(fields)[1:]
+    return flask.Response(body, mimetype='application/json')
+
+
 def get_image_url(image_name):
     return "/upload/{}".format(image_name)
 
+
+def paging_params(args):
+    item_id = 0
+    created_at = 0
+
+    item_id_str = args.get('item_id')
+    if item_id_str:
+        if not item_id_str.isdecimal() or int(item_id_str) < 0:
+            http_json_error(requests.codes['bad_request'], "item_id param error")
+        item_id = int(item_id_str)
+
+    created_at_str = args.get('created_at')
+    if created_at_str:
+        if not created_at_str.isdecimal() or int(created_at_str) < 0:
+            http_json_error(requests.codes['bad_request'], "created_at param error")
+        created_at = int(created_at_str)
+
+    return item_id, created_at
+
 # API
 @app.route("/initialize", methods=["POST"])
 def post_initialize():
+    started = time.monotonic()
     conn = dbh()
+    timer = PhaseTimer()
 
-    subprocess.call(["../sql/init.sh"])
+    try:
+        restored = None
+        if RESET_MODE == 'snapshot':
+            with timer.phase('restore'):
+                restored = restore_snapshot(conn)
+        if restored is None:
+            with timer.phase('init_sh'):
+                subprocess.call(["../sql/init.sh"])
+            with timer.phase('migrations'):
+                drop_python_tables(conn)
+                run_migrations(conn)
+            # copying every table would eat into the benchmarker's deadline, so snapshots are only
+            # taken by snapshot.py ahead of time
+    except MySQLdb.Error as err:
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "db error")
 
     payment_service_url = flask.request.json.get('payment_service_url', Constants.DEFAULT_PAYMENT_SERVICE_URL)
     shipment_service_url = flask.request.json.get('shipment_service_url', Constants.DEFAULT_SHIPMENT_SERVICE_URL)
@@ -263,177 +2151,107 @@ def post_initialize():
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify({
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_RESET)
+    config_cache.populate({
+        "payment_service_url": dict(name="payment_service_url", val=payment_service_url),
+        "shipment_service_url": dict(name="shipment_service_url", val=shipment_service_url),
+    })
+    with timer.phase('warmup'):
+        warmup = warm_up(min(time.monotonic() + WARMUP_BUDGET, started + INITIALIZE_DEADLINE))
+
+    app.logger.info("initialize: %s", timer.server_timing())
+    app.logger.info("warm-up: %s", json.dumps(warmup))
+    last_initialize.clear()
+    last_initialize.update(mode='snapshot' if restored else 'init_sh', phases=dict(timer.phases), warmup=warmup)
+
+    res = jsonify({
         "campaign": 0,  # キャンペーン実施時には還元率の設定を返す。詳しくはマニュアルを参照のこと。
         "language": "python" # 実装言語を返す
     })
+    res.headers['Server-Timing'] = timer.server_timing()
+    return res
 
 
 @app.route("/new_items.json", methods=["GET"])
 def get_new_items():
     # TODO: check err
 
-    item_id = 0
-    created_at = 0
-
-    item_id_str = flask.request.args.get('item_id')
-    if item_id_str:
-        if not item_id_str.isdecimal() or int(item_id_str) < 0:
-            http_json_error(requests.codes['bad_request'], "item_id param error")
-        item_id = int(item_id_str)
-
-    created_at_str = flask.request.args.get('created_at')
-    if created_at_str:
-        if not created_at_str.isdecimal() or int(created_at_str) < 0:
-            http_json_error(requests.codes['bad_request'], "created_at param error")
-        created_at = int(created_at_str)
-
-    items = []
+    item_id, created_at = paging_params(flask.request.args)
 
     try:
-        conn = dbh()
-        with conn.cursor() as c:
-            if item_id > 0 and created_at > 0:
-                # paging
-                sql = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    datetime.datetime.fromtimestamp(created_at),
-                    datetime.datetime.fromtimestamp(created_at),
-                    item_id,
-                    Constants.ITEMS_PER_PAGE + 1,
-                ))
-            else:
-                # 1st page
-                sql = "SELECT * FROM `items` WHERE `status` IN (%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    Constants.ITEMS_PER_PAGE + 1
-                ))
+        item_ids = item_timelines.page(created_at, item_id, Constants.ITEMS_PER_PAGE + 1)
+        has_next = len(item_ids) > Constants.ITEMS_PER_PAGE
+        fragments = get_item_fragments(item_ids[:Constants.ITEMS_PER_PAGE], item_timelines.load_items)
 
-            item_simples = []
+        if fragments is None:
+            generation = item_fragments.generation
+            items = get_new_items_from_db(created_at, item_id)
+            has_next = len(items) > Constants.ITEMS_PER_PAGE
+            items = {item["id"]: item for item in items[:Constants.ITEMS_PER_PAGE]}
+            fragments = get_item_fragments(list(items), lambda item_ids: items, generation)
 
-            while True:
-                item = c.fetchone()
-
-                if item is None:
-                    break
-
-                seller = get_user_simple_by_id(item["seller_id"])
-                category = get_category_by_id(item["category_id"])
-
-                item["category"] = category
-                item["seller"] = to_user_json(seller)
-                item["image_url"] = get_image_url(item["image_name"])
-                item = to_item_json(item, simple=True)
-
-                item_simples.append(item)
-
-            has_next = False
-            if len(item_simples) > Constants.ITEMS_PER_PAGE:
-                has_next = True
-                item_simples = item_simples[:Constants.ITEMS_PER_PAGE]
+        items_json = render_item_simples(fragments)
 
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify(dict(
-        items=item_simples,
-        has_next=has_next,
-    ))
+    return jsonify_items(items_json, has_next=has_next)
 
 
-@app.route("/new_items/<root_category_id>.json", methods=["GET"])
-def get_new_category_items(root_category_id=None):
+def get_new_items_from_db(created_at, item_id):
     conn = dbh()
-
-    root_category = get_category_by_id(root_category_id)
-
-    item_id = 0
-    created_at = 0
-
-    item_id_str = flask.request.args.get('item_id')
-    if item_id_str:
-        if not item_id_str.isdecimal() or int(item_id_str) < 0:
-            http_json_error(requests.codes['bad_request'], "item_id param error")
-        item_id = int(item_id_str)
-
-    created_at_str = flask.request.args.get('created_at')
-    if created_at_str:
-        if not created_at_str.isdecimal() or int(created_at_str) < 0:
-            http_json_error(requests.codes['bad_request'], "created_at param error")
-        created_at = int(created_at_str)
-
-    category_ids = []
     with conn.cursor() as c:
-        try:
-            sql = "SELECT id FROM `categories` WHERE parent_id=%s"
-            c.execute(sql, (
-                root_category_id,
-            ))
+        c.execute(*Queries.new_items(created_at, item_id))
+        return c.fetchall()
 
-            while True:
-                category = c.fetchone()
-                if category is None:
-                    break
-                category_ids.append(category["id"])
-
-            if item_id > 0 and created_at > 0:
-                sql = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND category_id IN ("+ ",".join(["%s"]*len(category_ids))+ ") AND (`created_at` < %s OR (`created_at` < %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    *category_ids,
-                    datetime.datetime.fromtimestamp(created_at),
-                    datetime.datetime.fromtimestamp(created_at),
-                    item_id,
-                    Constants.ITEMS_PER_PAGE + 1,
-                ))
-            else:
-
-                sql = "SELECT * FROM `items` WHERE `status` IN (%s,%s) AND category_id IN ("+ ",".join(["%s"]*len(category_ids))+ ") ORDER BY created_at DESC, id DESC LIMIT %s"
-                c.execute(sql, (
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    *category_ids,
-                    Constants.ITEMS_PER_PAGE + 1,
-                ))
 
-            item_simples = []
-            while True:
-                item = c.fetchone()
+@app.route("/new_items/<root_category_id>.json", methods=["GET"])
+def get_new_category_items(root_category_id=None):
+    if not root_category_id.isdecimal() or int(root_category_id) <= 0:
+        http_json_error(requests.codes['bad_request'], "incorrect category id")
 
-                if item is None:
-                    break
+    root_category = get_category_by_id(root_category_id)
+    if root_category is None or root_category['parent_id'] != 0:
+        http_json_error(requests.codes['not_found'], "category not found")
 
-                seller = get_user_simple_by_id(item["seller_id"])
-                category = get_category_by_id(item["category_id"])
+    item_id, created_at = paging_params(flask.request.args)
 
-                item["category"] = category
-                item["seller"] = to_user_json(seller)
-                item["image_url"] = get_image_url(item["image_name"])
-                item = to_item_json(item, simple=True)
+    try:
+        item_ids = item_timelines.page(created_at, item_id, Constants.ITEMS_PER_PAGE + 1, root_category["id"])
+        has_next = len(item_ids) > Constants.ITEMS_PER_PAGE
+        fragments = get_item_fragments(item_ids[:Constants.ITEMS_PER_PAGE], item_timelines.load_items)
 
-                item_simples.append(item)
+        if fragments is None:
+            generation = item_fragments.generation
+            items = get_new_category_items_from_db(root_category["id"], created_at, item_id)
+            has_next = len(items) > Constants.ITEMS_PER_PAGE
+            items = {item["id"]: item for item in items[:Constants.ITEMS_PER_PAGE]}
+            fragments = get_item_fragments(list(items), lambda item_ids: items, generation)
 
-        except MySQLdb.Error as err:
-            app.logger.exception(err)
-            http_json_error(requests.codes['internal_server_error'], "db error")
+        items_json = render_item_simples(fragments)
 
-    has_next = False
-    if len(item_simples) > Constants.ITEMS_PER_PAGE:
-        has_next = True
-        item_simples = item_simples[:Constants.ITEMS_PER_PAGE]
+    except MySQLdb.Error as err:
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify(dict(
+    return jsonify_items(
+        items_json,
         root_category_id=root_category["id"],
         root_category_name=root_category["category_name"],
-        items=item_simples,
         has_next=has_next,
-    ))
+    )
+
+
+def get_new_category_items_from_db(root_category_id, created_at, item_id):
+    category_ids = get_category_tree().child_ids(root_category_id)
+    if not category_ids:
+        return []
+
+    conn = dbh()
+    with conn.cursor() as c:
+        c.execute(*Queries.category_items(category_ids, created_at, item_id))
+        return c.fetchall()
 
 
 @app.route("/users/transactions.json", methods=["GET"])
@@ -441,99 +2259,47 @@ def get_transactions():
     user = get_user()
     conn = dbh()
 
-    item_id = 0
-    created_at = 0
-
-    item_id_str = flask.request.args.get('item_id')
-    if item_id_str:
-        if not item_id_str.isdecimal() or int(item_id_str) < 0:
-            http_json_error(requests.codes['bad_request'], "item_id param error")
-        item_id = int(item_id_str)
-
-    created_at_str = flask.request.args.get('created_at')
-    if created_at_str:
-        if not created_at_str.isdecimal() or int(created_at_str) < 0:
-            http_json_error(requests.codes['bad_request'], "created_at param error")
-        created_at = int(created_at_str)
+    item_id, created_at = paging_params(flask.request.args)
 
     with conn.cursor() as c:
 
         try:
+            c.execute(*Queries.transactions(user['id'], created_at, item_id))
 
-            if item_id > 0 and created_at > 0:
-                sql = "SELECT * FROM `items` WHERE (`seller_id` = %s OR `buyer_id` = %s) AND `status` IN (%s,%s,%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    user['id'],
-                    user['id'],
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_TRADING,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    Constants.ITEM_STATUS_CANCEL,
-                    Constants.ITEM_STATUS_STOP,
-                    datetime.datetime.fromtimestamp(created_at),
-                    datetime.datetime.fromtimestamp(created_at),
-                    item_id,
-                    Constants.TRANSACTIONS_PER_PAGE + 1,
-                ))
+            items = sorted(c.fetchall(), key=lambda item: (item["created_at"], item["id"]), reverse=True)
+            has_next = len(items) > Constants.TRANSACTIONS_PER_PAGE
+            items = items[:Constants.TRANSACTIONS_PER_PAGE]
 
-            else:
-                sql = "SELECT * FROM `items` WHERE (`seller_id` = %s OR `buyer_id` = %s ) AND `status` IN (%s,%s,%s,%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, [
-                    user['id'],
-                    user['id'],
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_TRADING,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    Constants.ITEM_STATUS_CANCEL,
-                    Constants.ITEM_STATUS_STOP,
-                    Constants.TRANSACTIONS_PER_PAGE + 1,
-                ])
-
-            item_details = []
-            while True:
-                item = c.fetchone()
+            item_details = to_item_jsons(items, simple=False)
 
-                if item is None:
-                    break
+            transaction_evidences = {}
+            shippings = {}
+            if item_details:
+                c.execute(*Queries.transaction_evidences([item["id"] for item in item_details]))
+                for transaction_evidence in c.fetchall():
+                    transaction_evidences[transaction_evidence["item_id"]] = transaction_evidence
 
-                seller = get_user_simple_by_id(item["seller_id"])
-                category = get_category_by_id(item["category_id"])
-
-                item["category"] = category
-                item["seller"] = to_user_json(seller)
-                item["image_url"] = get_image_url(item["image_name"])
-                item = to_item_json(item, simple=False)
-
-                item_details.append(item)
-
-                with conn.cursor() as c2:
-                    sql = "SELECT * FROM `transaction_evidences` WHERE `item_id` = %s"
-                    c2.execute(sql, [item['id']])
-                    transaction_evidence = c2.fetchone()
+            if transaction_evidences:
+                c.execute(*Queries.shippings([transaction_evidence["id"] for transaction_evidence in transaction_evidences.values()]))
+                for shipping in c.fetchall():
+                    shippings[shipping["transaction_evidence_id"]] = shipping
 
+            for transaction_evidence in transaction_evidences.values():
+                if transaction_evidence["id"] not in shippings:
+                    http_json_error(requests.codes['not_found'], "shipping not found")
 
-                    if transaction_evidence:
-                        sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s"
-                        c2.execute(sql, [transaction_evidence["id"]])
-                        shipping = c2.fetchone()
-                        if not shipping:
-                            http_json_error(requests.codes['not_found'], "shipping not found")
+            shipping_statuses = get_shipping_statuses(shippings.values())
 
-                        ssr = api_shipment_status(get_shipment_service_url(), {"reserve_id": shipping["reserve_id"]})
-                        item["transaction_evidence_id"] = transaction_evidence["id"]
-                        item["transaction_evidence_status"] = transaction_evidence["status"]
-                        item["shipping_status"] = ssr["status"]
+            for item in item_details:
+                transaction_evidence = transaction_evidences.get(item["id"])
+                if transaction_evidence:
+                    add_transaction_fields(item, transaction_evidence, shipping_statuses)
 
         except MySQLdb.Error as err:
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
 
-    has_next = False
-    if len(item_details) > Constants.TRANSACTIONS_PER_PAGE:
-        has_next = True
-        item_details = item_details[:Constants.TRANSACTIONS_PER_PAGE]
-
-    return flask.jsonify(dict(
+    return jsonify(dict(
         items=item_details,
         has_next=has_next,
     ))
@@ -544,76 +2310,26 @@ def get_user_items(user_id=None):
     user = get_user_simple_by_id(user_id)
     conn = dbh()
 
-    item_id = 0
-    created_at = 0
-
-    item_id_str = flask.request.args.get('item_id')
-    if item_id_str:
-        if not item_id_str.isdecimal() or int(item_id_str) < 0:
-            http_json_error(requests.codes['bad_request'], "item_id param error")
-        item_id = int(item_id_str)
-
-    created_at_str = flask.request.args.get('created_at')
-    if created_at_str:
-        if not created_at_str.isdecimal() or int(created_at_str) < 0:
-            http_json_error(requests.codes['bad_request'], "created_at param error")
-        created_at = int(created_at_str)
+    item_id, created_at = paging_params(flask.request.args)
 
     with conn.cursor() as c:
         try:
-            if item_id > 0 and created_at > 0:
-                sql = "SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    user['id'],
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_TRADING,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    datetime.datetime.fromtimestamp(created_at),
-                    datetime.datetime.fromtimestamp(created_at),
-                    item_id,
-                    Constants.ITEMS_PER_PAGE + 1,
-                ))
-
-            else:
-                sql = "SELECT * FROM `items` WHERE `seller_id` = %s AND `status` IN (%s,%s,%s) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
-                c.execute(sql, (
-                    user['id'],
-                    Constants.ITEM_STATUS_ON_SALE,
-                    Constants.ITEM_STATUS_TRADING,
-                    Constants.ITEM_STATUS_SOLD_OUT,
-                    Constants.ITEMS_PER_PAGE + 1,
-                ))
-
-            item_simples = []
-            while True:
-                item = c.fetchone()
-
-                if item is None:
-                    break
-
-                seller = get_user_simple_by_id(item["seller_id"])
-                category = get_category_by_id(item["category_id"])
-
-                item["category"] = category
-                item["seller"] = to_user_json(seller)
-                item["image_url"] = get_image_url(item["image_name"])
-                item = to_item_json(item, simple=True)
-                item_simples.append(item)
+            generation = item_fragments.generation
+            c.execute(*Queries.user_items(user['id'], created_at, item_id))
+            items = c.fetchall()
+            has_next = len(items) > Constants.ITEMS_PER_PAGE
+            items = {item["id"]: item for item in items[:Constants.ITEMS_PER_PAGE]}
+            items_json = render_item_simples(get_item_fragments(list(items), lambda item_ids: items, generation))
 
         except MySQLdb.Error as err:
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
 
-    has_next = False
-    if len(item_simples) > Constants.ITEMS_PER_PAGE:
-        has_next = True
-        item_simples = item_simples[:Constants.ITEMS_PER_PAGE]
-
-    return flask.jsonify(dict(
+    return jsonify_items(
+        items_json,
         user=to_user_json(user),
-        items=item_simples,
         has_next=has_next,
-    ))
+    )
 
 
 @app.route("/items/<item_id>.json", methods=["GET"])
@@ -629,15 +2345,12 @@ def get_item(item_id=None):
             if item is None:
                 http_json_error(requests.codes['not_found'], "item not found")
 
-            seller = get_user_simple_by_id(item["seller_id"])
-            category = get_category_by_id(item["category_id"])
+            is_party = (user["id"] == item["seller_id"] or user["id"] == item["buyer_id"]) and item["buyer_id"]
+            if is_party:
+                get_user_simples_by_ids([item["seller_id"], item["buyer_id"]])
+            item = to_item_jsons([item], simple=False)[0]
 
-            item["category"] = category
-            item["seller"] = to_user_json(seller)
-            item["image_url"] = get_image_url(item["image_name"])
-            item = to_item_json(item, simple=False)
-
-            if (user["id"] == item["seller_id"] or user["id"] == item["buyer_id"]) and item["buyer_id"]:
+            if is_party:
                 buyer = get_user_simple_by_id(item["buyer_id"])
 
                 item["buyer"] = to_user_json(buyer)
@@ -650,16 +2363,12 @@ def get_item(item_id=None):
                 #     http_json_error(requests.codes['not_found'], "transaction_evidence not found")
 
 
-                sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s"
-                c.execute(sql, (transaction_evidence["id"],))
+                c.execute(*Queries.shippings([transaction_evidence["id"]]))
                 shipping = c.fetchone()
                 if not shipping:
                     http_json_error(requests.codes['not_found'], "shipping not found")
 
-                ssr = api_shipment_status(get_shipment_service_url(), {"reserve_id": shipping["reserve_id"]})
-                item["transaction_evidence_id"] = transaction_evidence["id"]
-                item["transaction_evidence_status"] = transaction_evidence["status"]
-                item["shipping_status"] = ssr["status"]
+                add_transaction_fields(item, transaction_evidence, get_shipping_statuses([shipping]))
             else:
                 item["buyer"] = {}
                 item["buyer_id"] = 0
@@ -668,7 +2377,7 @@ def get_item(item_id=None):
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify(item)
+    return jsonify(item)
 
 
 @app.route("/items/edit", methods=["POST"])
@@ -719,7 +2428,10 @@ def post_item_edit():
             conn.rollback()
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(dict(
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [item["id"]])
+
+    return jsonify(dict(
         item_id=item["id"],
         item_price=item["price"],
         item_created_at=int(item["created_at"].timestamp()),
@@ -734,28 +2446,49 @@ def post_buy():
 
     conn = dbh()
     try:
-        conn.begin()
         with conn.cursor() as c:
-            sql = "SELECT * FROM `items` WHERE `id` = %s FOR UPDATE"
+            sql = "SELECT * FROM `items` WHERE `id` = %s"
             c.execute(sql, (flask.request.json['item_id'],))
             target_item = c.fetchone()
             if target_item is None:
-                conn.rollback()
                 http_json_error(requests.codes['not_found'], "item not found")
             if target_item['status'] != Constants.ITEM_STATUS_ON_SALE:
-                conn.rollback()
                 http_json_error(requests.codes['forbidden'], "item is not for sale")
             if target_item['seller_id'] == buyer['id']:
-                conn.rollback()
                 http_json_error(requests.codes['forbidden'], "自分の商品は買えません")
-            sql = "SELECT * FROM `users` WHERE `id` = %s FOR UPDATE"
+            sql = "SELECT `id`, `account_name`, `address` FROM `users` WHERE `id` = %s"
             c.execute(sql, (target_item['seller_id'],))
             seller = c.fetchone()
             if seller is None:
-                conn.rollback()
                 http_json_error(requests.codes['not_found'], "seller not found")
             category = get_category_by_id(target_item['category_id'])
-            # TODO: check category error
+            if category is None:
+                http_json_error(requests.codes['internal_server_error'], "category id error")
+
+        # reserve the item in a short transaction: the locked re-read picks one winner among concurrent
+        # buyers and gives the price, name and description as of the reservation, since /items/edit can
+        # commit after the read above. The row lock is released before the external calls instead of
+        # being held across them. The shippings row goes in with the reservation so readers never see a
+        # trade without one; its reserve_id stays empty until /create answers.
+        conn.begin()
+        with conn.cursor() as c:
+            sql = "SELECT * FROM `items` WHERE `id` = %s FOR UPDATE"
+            c.execute(sql, (target_item['id'],))
+            target_item = c.fetchone()
+            if target_item is None or target_item['status'] != Constants.ITEM_STATUS_ON_SALE:
+                conn.rollback()
+                http_json_error(requests.codes['forbidden'], "item is not for sale")
+            sql = "UPDATE `items` SET `buyer_id` = %s, `status` = %s, `updated_at` = %s WHERE `id` = %s AND `status` = %s"
+            c.execute(sql, (
+                buyer['id'],
+                Constants.ITEM_STATUS_TRADING,
+                datetime.datetime.now(),
+                target_item['id'],
+                Constants.ITEM_STATUS_ON_SALE,
+            ))
+            if c.rowcount == 0:
+                conn.rollback()
+                http_json_error(requests.codes['forbidden'], "item is not for sale")
             sql = "INSERT INTO `transaction_evidences` (`seller_id`, `buyer_id`, `status`, `item_id`, `item_name`, " \
                   "`item_price`, `item_description`, `item_category_id`, `item_root_category_id`) " \
                   "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
@@ -768,61 +2501,9 @@ def post_buy():
                 target_item['price'],
                 target_item['description'],
                 category['id'],
-                category['parent_id'],
-            ))
-            transaction_evidence_id = c.lastrowid
-            sql = "UPDATE `items` SET `buyer_id` = %s, `status` = %s, `updated_at` = %s WHERE `id` = %s"
-            c.execute(sql, (
-                buyer['id'],
-                Constants.ITEM_STATUS_TRADING,
-                datetime.datetime.now(),
-                target_item['id'],
+                category['parent_id'],
             ))
-
-            host = get_shipment_service_url()
-            try:
-                res = requests.post(host + "/create",
-                                    headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
-                                    json=dict(
-                                        to_address=buyer['address'],
-                                        to_name=buyer['account_name'],
-                                        from_address=seller['address'],
-                                            from_name=seller['account_name'],
-                                    ))
-                res.raise_for_status()
-            except (socket.gaierror, requests.HTTPError) as err:
-                conn.rollback()
-                app.logger.exception(err)
-                http_json_error(requests.codes['internal_server_error'])
-
-            shipping_res = res.json()
-
-            host = get_payment_service_url()
-            try:
-                res = requests.post(host + "/token",
-                                    json=dict(
-                                        shop_id=Constants.PAYMENT_SERVICE_ISUCARI_SHOP_ID,
-                                        api_key=Constants.PAYMENT_SERVICE_ISUCARI_API_KEY,
-                                        token=flask.request.json['token'],
-                                        price=target_item['price'],
-                                    ))
-                res.raise_for_status()
-            except (socket.gaierror, requests.HTTPError) as err:
-                conn.rollback()
-                app.logger.exception(err)
-                http_json_error(requests.codes['internal_server_error'])
-
-            payment_res = res.json()
-            if payment_res['status'] == "invalid":
-                conn.rollback()
-                http_json_error(requests.codes["bad_request"], "カード情報に誤りがあります")
-            if payment_res['status'] == "fail":
-                conn.rollback()
-                http_json_error(requests.codes["bad_request"], "カードの残高が足りません")
-            if payment_res['status'] != "ok":
-                conn.rollback()
-                http_json_error(requests.codes["bad_request"], "想定外のエラー")
-
+            transaction_evidence_id = c.lastrowid
             sql = "INSERT INTO `shippings` (`transaction_evidence_id`, `status`, `item_name`, `item_id`, " \
                   "`reserve_id`, `reserve_time`, `to_address`, `to_name`, `from_address`, `from_name`, `img_binary`) " \
                   "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
@@ -831,8 +2512,8 @@ def post_buy():
                 Constants.SHIPPING_STATUS_INITIAL,
                 target_item["name"],
                 target_item["id"],
-                shipping_res["reserve_id"],
-                shipping_res["reserve_time"],
+                "",
+                0,
                 buyer["address"],
                 buyer["account_name"],
                 seller["address"],
@@ -843,7 +2524,96 @@ def post_buy():
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(dict(transaction_evidence_id=transaction_evidence_id))
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [target_item['id']])
+
+    # /token charges the card and cannot be undone, so it only goes out once everything that can
+    # still fail and cancel the reservation has succeeded
+    client = get_service_client()
+    try:
+        shipping_res = client.post(
+            get_shipment_service_url(), "/create",
+            headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
+            json=dict(
+                to_address=buyer['address'],
+                to_name=buyer['account_name'],
+                from_address=seller['address'],
+                from_name=seller['account_name'],
+            ),
+        ).json()
+    except (socket.gaierror, requests.RequestException) as err:
+        cancel_reserved_item(target_item, transaction_evidence_id)
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "failed to request to shipment service")
+
+    try:
+        with conn.cursor() as c:
+            sql = "UPDATE `shippings` SET `reserve_id` = %s, `reserve_time` = %s, `updated_at` = %s " \
+                  "WHERE `transaction_evidence_id` = %s"
+            c.execute(sql, (
+                shipping_res["reserve_id"],
+                shipping_res["reserve_time"],
+                datetime.datetime.now(),
+                transaction_evidence_id,
+            ))
+    except MySQLdb.Error as err:
+        app.logger.exception(err)
+        cancel_reserved_item(target_item, transaction_evidence_id)
+        http_json_error(requests.codes['internal_server_error'], "db error")
+
+    try:
+        payment_res = client.post(
+            get_payment_service_url(), "/token",
+            json=dict(
+                shop_id=Constants.PAYMENT_SERVICE_ISUCARI_SHOP_ID,
+                api_key=Constants.PAYMENT_SERVICE_ISUCARI_API_KEY,
+                token=flask.request.json['token'],
+                price=target_item['price'],
+            ),
+        ).json()
+    except (socket.gaierror, requests.RequestException) as err:
+        cancel_reserved_item(target_item, transaction_evidence_id)
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "payment service is failed")
+
+    if payment_res['status'] != "ok":
+        cancel_reserved_item(target_item, transaction_evidence_id)
+        if payment_res['status'] == "invalid":
+            http_json_error(requests.codes["bad_request"], "カード情報に誤りがあります")
+        if payment_res['status'] == "fail":
+            http_json_error(requests.codes["bad_request"], "カードの残高が足りません")
+        http_json_error(requests.codes["bad_request"], "想定外のエラー")
+
+    return jsonify(dict(transaction_evidence_id=transaction_evidence_id))
+
+
+def cancel_reserved_item(target_item, transaction_evidence_id):
+    # undo post_buy's reservation; the conditions keep this from touching a trade that moved on
+    conn = dbh()
+    try:
+        conn.begin()
+        with conn.cursor() as c:
+            sql = "DELETE FROM `transaction_evidences` WHERE `id` = %s AND `status` = %s"
+            c.execute(sql, (transaction_evidence_id, Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING))
+            if c.rowcount == 0:
+                conn.rollback()
+                return
+            sql = "DELETE FROM `shippings` WHERE `transaction_evidence_id` = %s"
+            c.execute(sql, (transaction_evidence_id,))
+            sql = "UPDATE `items` SET `buyer_id` = 0, `status` = %s, `updated_at` = %s " \
+                  "WHERE `id` = %s AND `status` = %s"
+            c.execute(sql, (
+                Constants.ITEM_STATUS_ON_SALE,
+                target_item['updated_at'],
+                target_item['id'],
+                Constants.ITEM_STATUS_TRADING,
+            ))
+        conn.commit()
+    except MySQLdb.Error as err:
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "db error")
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [target_item['id']])
 
 
 @app.route("/sell", methods=["POST"])
@@ -859,7 +2629,7 @@ def post_sell():
         http_json_error(requests.codes['bad_request'], "商品価格は100ｲｽｺｲﾝ以上、1,000,000ｲｽｺｲﾝ以下にしてください")
 
     category = get_category_by_id(flask.request.form['category_id'])
-    if category['parent_id'] == 0:
+    if category is None or category['parent_id'] == 0:
         http_json_error(requests.codes['bad_request'], 'Incorrect category ID')
     user = get_user()
 
@@ -909,82 +2679,120 @@ def post_sell():
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify({
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_USER, [seller['id']])
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [item_id])
+
+    return jsonify({
         'id': item_id,
     })
 
 
-@app.route("/ship", methods=["POST"])
-def post_ship():
-    ensure_valid_csrf_token()
-    user = get_user()
-    conn = dbh()
-    with conn.cursor() as c:
-        try:
+def get_trade(item_id, user_id, party, transaction_evidence_status):
+    # unlocked snapshot of a trade; the transitions below re-check it with compare-and-set updates
+    try:
+        with dbh().cursor() as c:
             sql = "SELECT * FROM `transaction_evidences` WHERE `item_id` = %s"
-            c.execute(sql, (flask.request.json["item_id"],))
+            c.execute(sql, (item_id,))
             transaction_evidence = c.fetchone()
             if transaction_evidence is None:
                 http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-        except MySQLdb.Error as err:
-            app.logger.exception(err)
-            http_json_error(requests.codes['internal_server_error'], "db error")
-    if transaction_evidence["seller_id"] != user["id"]:
-        http_json_error(requests.codes['forbidden'], "権限がありません")
+            if transaction_evidence[party] != user_id:
+                http_json_error(requests.codes['forbidden'], "権限がありません")
 
-    try:
-        conn.begin()
-        with conn.cursor() as c:
-            sql = "SELECT * FROM `items` WHERE `id` = %s FOR UPDATE"
-            c.execute(sql, (flask.request.json["item_id"],))
+            sql = "SELECT `id`, `status` FROM `items` WHERE `id` = %s"
+            c.execute(sql, (item_id,))
             item = c.fetchone()
             if item is None:
-                conn.rollback()
                 http_json_error(requests.codes["not_found"], "item not found")
             if item["status"] != Constants.ITEM_STATUS_TRADING:
-                conn.rollback()
                 http_json_error(requests.codes["forbidden"], "商品が取引中ではありません")
 
-            sql = "SELECT * FROM `transaction_evidences` WHERE `id` = %s FOR UPDATE"
-            c.execute(sql, (transaction_evidence["id"],))
-            transaction_evidence = c.fetchone()
-            if transaction_evidence is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-            if transaction_evidence["status"] != Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING:
-                conn.rollback()
+            if transaction_evidence["status"] != transaction_evidence_status:
                 http_json_error(requests.codes['forbidden'], "準備ができていません")
 
-            sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s FOR UPDATE"
+            sql = "SELECT `transaction_evidence_id`, `status`, `reserve_id` FROM `shippings` WHERE `transaction_evidence_id` = %s"
             c.execute(sql, (transaction_evidence["id"],))
             shipping = c.fetchone()
             if shipping is None:
-                conn.rollback()
                 http_json_error(requests.codes["not_found"], "shipping not found")
+            if not shipping["reserve_id"]:
+                http_json_error(requests.codes['forbidden'], "準備ができていません")
+    except MySQLdb.Error as err:
+        app.logger.exception(err)
+        http_json_error(requests.codes['internal_server_error'], "db error")
 
-            try:
-                host = get_shipment_service_url()
-                res = requests.post(host + "/request",
-                                    headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
-                                    json=dict(reserve_id=shipping["reserve_id"]))
-                res.raise_for_status()
-            except (socket.gaierror, requests.HTTPError) as err:
-                conn.rollback()
-                app.logger.exception(err)
-                http_json_error(requests.codes["internal_server_error"], "failed to request to shipment service")
+    return item, transaction_evidence, shipping
+
+
+class QRCodeStore(object):
+    # content addressed: a file is never rewritten, so its sha256 doubles as the ETag
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def path(self, digest):
+        return self.root / digest[:2] / (digest + '.png')
 
-            sql = "UPDATE `shippings` SET `status` = %s, `img_binary` = %s, `updated_at` = %s WHERE `transaction_evidence_id` = %s"
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, str(path))
+        return digest
+
+
+qrcode_store = QRCodeStore(os.getenv('QRCODE_DIR', str(base_path / 'qrcode')))
+
+
+@app.route("/ship", methods=["POST"])
+def post_ship():
+    ensure_valid_csrf_token()
+    user = get_user()
+    _, transaction_evidence, shipping = get_trade(
+        flask.request.json["item_id"], user["id"], "seller_id", Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING)
+
+    try:
+        host = get_shipment_service_url()
+        res = get_service_client().post(host, "/request",
+                                        headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
+                                        json=dict(reserve_id=shipping["reserve_id"]))
+    except (socket.gaierror, requests.RequestException) as err:
+        app.logger.exception(err)
+        http_json_error(requests.codes["internal_server_error"], "failed to request to shipment service")
+
+    img_hash = qrcode_store.put(res.content)
+
+    conn = dbh()
+    try:
+        conn.begin()
+        with conn.cursor() as c:
+            sql = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s " \
+                  "WHERE `transaction_evidence_id` = %s AND `status` = %s"
             c.execute(sql, (
                 Constants.SHIPPING_STATUS_WAIT_PICKUP,
-                res.content,
                 datetime.datetime.now(),
                 transaction_evidence["id"],
+                shipping["status"],
             ))
+            if c.rowcount == 0:
+                conn.rollback()
+                http_json_error(requests.codes['forbidden'], "準備ができていません")
+
+            sql = "INSERT INTO `shipping_images` (`transaction_evidence_id`, `img_hash`) VALUES (%s, %s) " \
+                  "ON DUPLICATE KEY UPDATE `img_hash` = VALUES(`img_hash`)"
+            c.execute(sql, (transaction_evidence["id"], img_hash))
         conn.commit()
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(dict(
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_SHIPPING, [transaction_evidence["id"]])
+
+    return jsonify(dict(
         path="/transactions/{}.png".format(transaction_evidence["id"]),
         reserve_id=shipping["reserve_id"],
     ))
@@ -994,158 +2802,95 @@ def post_ship():
 def post_ship_done():
     ensure_valid_csrf_token()
     user = get_user()
-    conn = dbh()
-    with conn.cursor() as c:
-        try:
-            sql = "SELECT * FROM `transaction_evidences` WHERE `item_id` = %s"
-            c.execute(sql, [flask.request.json["item_id"]])
-            transaction_evidence = c.fetchone()
-            if transaction_evidence is None:
-                http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-        except MySQLdb.Error as err:
-            app.logger.exception(err)
-            http_json_error(requests.codes['internal_server_error'], "db error")
-    if transaction_evidence["seller_id"] != user["id"]:
-        http_json_error(requests.codes['forbidden'], "権限がありません")
+    _, transaction_evidence, shipping = get_trade(
+        flask.request.json["item_id"], user["id"], "seller_id", Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING)
 
+    shipping_status = get_shipment_status(shipping)
+    if shipping_status not in (Constants.SHIPPING_STATUS_DONE, Constants.SHIPPING_STATUS_SHIPPING):
+        http_json_error(requests.codes["forbidden"], "shipment service側で配送中か配送完了になっていません")
+
+    conn = dbh()
     try:
         conn.begin()
         with conn.cursor() as c:
-            sql = "SELECT * FROM `items` WHERE `id` = %s FOR UPDATE"
-            c.execute(sql, [flask.request.json["item_id"]])
-            item = c.fetchone()
-            if item is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "item not found")
-            if item["status"] != Constants.ITEM_STATUS_TRADING:
-                conn.rollback()
-                http_json_error(requests.codes["forbidden"], "商品が取引中ではありません")
-
-            sql = "SELECT * FROM `transaction_evidences` WHERE `id` = %s FOR UPDATE"
-            c.execute(sql, [transaction_evidence["id"]])
-            transaction_evidence = c.fetchone()
-            if transaction_evidence is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-            if transaction_evidence["status"] != Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING:
-                conn.rollback()
-                http_json_error(requests.codes['forbidden'], "準備ができていません")
-
-            sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s FOR UPDATE"
-            c.execute(sql, [transaction_evidence["id"]])
-            shipping = c.fetchone()
-            if shipping is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "shipping not found")
-
-            ssr = api_shipment_status(get_shipment_service_url(), {"reserve_id": shipping["reserve_id"]})
-
-            if ssr["status"] not in (Constants.SHIPPING_STATUS_DONE, Constants.SHIPPING_STATUS_SHIPPING):
-                http_json_error(requests.codes["forbidden"], "shipment service側で配送中か配送完了になっていません")
-
-            sql = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s WHERE `transaction_evidence_id` = %s"
+            sql = "UPDATE `transaction_evidences` SET `status` = %s, `updated_at` = %s WHERE `id` = %s AND `status` = %s"
             c.execute(sql, (
-                ssr["status"],
+                Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_DONE,
                 datetime.datetime.now(),
                 transaction_evidence["id"],
+                Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_SHIPPING,
             ))
+            if c.rowcount == 0:
+                conn.rollback()
+                http_json_error(requests.codes['forbidden'], "準備ができていません")
 
-            sql = "UPDATE `transaction_evidences` SET `status` = %s, `updated_at` = %s WHERE `id` = %s"
+            sql = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s WHERE `transaction_evidence_id` = %s"
             c.execute(sql, (
-                Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_DONE,
+                shipping_status,
                 datetime.datetime.now(),
                 transaction_evidence["id"],
             ))
-
         conn.commit()
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(dict(transaction_evidence_id=transaction_evidence["id"]))
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_SHIPPING, [transaction_evidence["id"]])
+
+    return jsonify(dict(transaction_evidence_id=transaction_evidence["id"]))
 
 
 @app.route("/complete", methods=["POST"])
 def post_complete():
     ensure_valid_csrf_token()
     user = get_user()
-    conn = dbh()
-
-    item_id = flask.request.json["item_id"]
-
-    with conn.cursor() as c:
-        try:
-            sql = "SELECT * FROM `transaction_evidences` WHERE `item_id` = %s"
-            c.execute(sql, (item_id,))
-            transaction_evidence = c.fetchone()
-            if transaction_evidence is None:
-                http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-        except MySQLdb.Error as err:
-            app.logger.exception(err)
-            http_json_error(requests.codes['internal_server_error'], "db error")
+    item, transaction_evidence, shipping = get_trade(
+        flask.request.json["item_id"], user["id"], "buyer_id", Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_DONE)
 
-    if transaction_evidence["buyer_id"] != user["id"]:
-        http_json_error(requests.codes['forbidden'], "権限がありません")
+    if get_shipment_status(shipping) != Constants.SHIPPING_STATUS_DONE:
+        http_json_error(requests.codes["bad_request"], "shipment service側で配送完了になっていません")
 
+    conn = dbh()
     try:
         conn.begin()
         with conn.cursor() as c:
-            sql = "SELECT * FROM `items` WHERE `id` = %s FOR UPDATE"
-            c.execute(sql, (item_id,))
-            item = c.fetchone()
-            if item is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "item not found")
-            if item["status"] != Constants.ITEM_STATUS_TRADING:
-                conn.rollback()
-                http_json_error(requests.codes["forbidden"], "商品が取引中ではありません")
-
-            sql = "SELECT * FROM `transaction_evidences` WHERE `item_id` = %s FOR UPDATE"
-            c.execute(sql, (item_id,))
-            transaction_evidence = c.fetchone()
-            if transaction_evidence is None:
-                conn.rollback()
-                http_json_error(requests.codes["not_found"], "transaction_evidences not found")
-            if transaction_evidence["status"] != Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_DONE:
-                conn.rollback()
-                http_json_error(requests.codes['forbidden'], "準備ができていません")
-
-            sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s FOR UPDATE"
-            c.execute(sql, [transaction_evidence["id"]])
-            shipping = c.fetchone()
-
-            ssr = api_shipment_status(get_shipment_service_url(), {"reserve_id": shipping["reserve_id"]})
-
-            if ssr["status"] != Constants.SHIPPING_STATUS_DONE:
-                conn.rollback()
-                http_json_error(requests.codes["bad_request"], "shipment service側で配送完了になっていません")
-
-            sql = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s WHERE `transaction_evidence_id` = %s"
-            c.execute(sql, (
-                Constants.SHIPPING_STATUS_DONE,
-                datetime.datetime.now(),
-                transaction_evidence["id"],
-            ))
-
-
-            sql = "UPDATE `transaction_evidences` SET `status` = %s, `updated_at` = %s WHERE `id` = %s"
+            sql = "UPDATE `transaction_evidences` SET `status` = %s, `updated_at` = %s WHERE `id` = %s AND `status` = %s"
             c.execute(sql, (
                 Constants.TRANSACTION_EVIDENCE_STATUS_DONE,
                 datetime.datetime.now(),
                 transaction_evidence["id"],
+                Constants.TRANSACTION_EVIDENCE_STATUS_WAIT_DONE,
             ))
+            if c.rowcount == 0:
+                conn.rollback()
+                http_json_error(requests.codes['forbidden'], "準備ができていません")
 
-            sql = "UPDATE `items` SET `status` = %s, `updated_at` = %s WHERE `id` = %s"
+            sql = "UPDATE `items` SET `status` = %s, `updated_at` = %s WHERE `id` = %s AND `status` = %s"
             c.execute(sql, (
                 Constants.ITEM_STATUS_SOLD_OUT,
                 datetime.datetime.now(),
                 item["id"],
+                Constants.ITEM_STATUS_TRADING,
             ))
+            if c.rowcount == 0:
+                conn.rollback()
+                http_json_error(requests.codes["forbidden"], "商品が取引中ではありません")
 
+            sql = "UPDATE `shippings` SET `status` = %s, `updated_at` = %s WHERE `transaction_evidence_id` = %s"
+            c.execute(sql, (
+                Constants.SHIPPING_STATUS_DONE,
+                datetime.datetime.now(),
+                transaction_evidence["id"],
+            ))
         conn.commit()
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(dict(transaction_evidence_id=transaction_evidence["id"]))
+
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [item["id"]])
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_SHIPPING, [transaction_evidence["id"]])
+
+    return jsonify(dict(transaction_evidence_id=transaction_evidence["id"]))
 
 
 @app.route("/transactions/<transaction_evidence_id>.png", methods=["GET"])
@@ -1169,7 +2914,9 @@ def get_qrcode(transaction_evidence_id):
             if transaction_evidence["seller_id"] != seller["id"]:
                 http_json_error(requests.codes['forbidden'], "権限がありません")
 
-            sql = "SELECT * FROM `shippings` WHERE `transaction_evidence_id` = %s"
+            sql = "SELECT s.`status`, i.`img_hash` FROM `shippings` s " \
+                  "LEFT JOIN `shipping_images` i ON i.`transaction_evidence_id` = s.`transaction_evidence_id` " \
+                  "WHERE s.`transaction_evidence_id` = %s"
             c.execute(sql, (transaction_evidence["id"],))
             shipping = c.fetchone()
 
@@ -1179,18 +2926,41 @@ def get_qrcode(transaction_evidence_id):
             if shipping["status"] != Constants.SHIPPING_STATUS_WAIT_PICKUP and shipping["status"] != Constants.SHIPPING_STATUS_SHIPPING:
                 http_json_error(requests.codes['forbidden'], "qrcode not available")
 
-            if len(shipping["img_binary"]) == 0:
-                http_json_error(requests.codes['internal_server_error'], "empty qrcode image")
+            img_hash = shipping["img_hash"]
+            if img_hash is None:
+                # shipped before the file store existed (e.g. the initial data): move the blob out once
+                sql = "SELECT `img_binary` FROM `shippings` WHERE `transaction_evidence_id` = %s"
+                c.execute(sql, (transaction_evidence["id"],))
+                img_binary = c.fetchone()["img_binary"]
+                if len(img_binary) == 0:
+                    http_json_error(requests.codes['internal_server_error'], "empty qrcode image")
+
+                img_hash = qrcode_store.put(img_binary)
+                sql = "INSERT IGNORE INTO `shipping_images` (`transaction_evidence_id`, `img_hash`) VALUES (%s, %s)"
+                c.execute(sql, (transaction_evidence["id"], img_hash))
 
         except MySQLdb.Error as err:
             app.logger.exception(err)
             http_json_error(requests.codes['internal_server_error'], "db error")
 
-    img_binary = shipping["img_binary"]
-    res = flask.make_response(img_binary)
-    res.headers.set('Content-Type', 'image/png')
+    path = qrcode_store.path(img_hash)
+    try:
+        f = path.open('rb')
+    except FileNotFoundError:
+        http_json_error(requests.codes['internal_server_error'], "empty qrcode image")
+
+    # wsgi.file_wrapper lets gunicorn hand the file to sendfile(2) instead of copying it through Python
+    res = flask.Response(
+        werkzeug.wsgi.wrap_file(flask.request.environ, f),
+        mimetype='image/png',
+        direct_passthrough=True,
+    )
+    res.content_length = os.fstat(f.fileno()).st_size
+    res.set_etag(img_hash)
+    res.cache_control.private = True
+    res.cache_control.no_cache = True
 
-    return  res
+    return res.make_conditional(flask.request)
 
 
 @app.route("/bump", methods=["POST"])
@@ -1238,7 +3008,9 @@ def post_bump():
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
 
-    return flask.jsonify({
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_ITEM, [target_item['id']])
+
+    return jsonify({
         'item_id': target_item['id'],
         'item_price': target_item['price'],
         'item_created_at': int(target_item['created_at'].timestamp()),
@@ -1255,18 +3027,14 @@ def get_settings():
     outputs['csrf_token'] = flask.session.get('csrf_token', '')
 
     try:
-        conn = dbh()
-        sql = "SELECT * FROM `categories`"
-        with conn.cursor() as c:
-            c.execute(sql)
-            categories = c.fetchall()
+        categories = get_category_tree().rows
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
     outputs['categories'] = categories
     outputs['payment_service_url'] = get_payment_service_url()
 
-    return flask.jsonify(outputs)
+    return jsonify(outputs)
 
 
 @app.route("/login", methods=["POST"])
@@ -1288,7 +3056,7 @@ def post_login():
 
     flask.session['user_id'] = user['id']
     flask.session['csrf_token'] = random_string(10)
-    return flask.jsonify(
+    return jsonify(
         to_user_json(user),
     )
 
@@ -1308,32 +3076,96 @@ def post_register():
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], 'db error')
 
+    get_invalidation_bus().publish(InvalidationBus.CHANNEL_USER, [user_id])
+
     flask.session['user_id'] = user_id
     flask.session['csrf_token'] = random_string(10)
-    return flask.jsonify({
+    return jsonify({
         'id': user_id,
         'account_name': flask.request.json['account_name'],
         'address': flask.request.json['address'],
     })
 
 
+REPORTS_CHUNK_SIZE = int(os.getenv('REPORTS_CHUNK_SIZE', 1000))
+
+
+def generate_reports(conn):
+    # SSDictCursor leaves the result on the server and fetchmany() pulls it a chunk at a time,
+    # so memory stays flat however many trades there are
+    with conn.cursor(SSDictCursor) as c:
+        sql = "SELECT `id`, `seller_id`, `buyer_id`, `status`, `item_id`, `item_name`, `item_price`, " \
+              "`item_description`, `item_category_id`, `item_root_category_id` " \
+              "FROM `transaction_evidences` WHERE `id` > 15007"
+        c.execute(sql)
+        # get_reports primes the generator up to here, so a failing query is still answered with a 500
+        yield
+
+        separator = b'['
+        try:
+            while True:
+                transaction_evidences = c.fetchmany(REPORTS_CHUNK_SIZE)
+                if not transaction_evidences:
+                    break
+                chunk = bytearray()
+                for transaction_evidence in transaction_evidences:
+                    chunk += separator
+                    chunk += json_bytes(transaction_evidence)
+                    separator = b','
+                yield bytes(chunk)
+        except MySQLdb.Error as err:
+            # the status line is already sent; all that is left is to cut the body short
+            app.logger.exception(err)
+            return
+        yield b'[]' if separator == b'[' else b']'
+
+
 @app.route("/reports.json", methods=["GET"])
 def get_reports():
+    chunks = generate_reports(dbh())
     try:
-        conn = dbh()
-        conn.begin()
-        with conn.cursor() as c:
-            sql = "SELECT * FROM `transaction_evidences` WHERE `id` > 15007"
-            c.execute(sql)
-            transaction_evidences = c.fetchall()
-
-            for k in transaction_evidences:
-                del k["created_at"]
-                del k["updated_at"]
+        next(chunks)
     except MySQLdb.Error as err:
         app.logger.exception(err)
         http_json_error(requests.codes['internal_server_error'], "db error")
-    return flask.jsonify(transaction_evidences)
+
+    # keeps the app context, and with it the pooled connection, until the last chunk is sent
+    return flask.Response(flask.stream_with_context(chunks), mimetype='application/json')
+
+
+@app.route("/debug/stats.json", methods=["GET"])
+def get_debug_stats():
+    ensure_local_request()
+    return jsonify({name: stats() for name, stats in debug_stats.items()})
+
+
+@app.route("/debug/profile", methods=["POST", "DELETE"])
+def post_debug_profile():
+    ensure_local_request()
+    if flask.request.method == 'DELETE':
+        profiler.configure(False)
+        return jsonify(profiler.stats())
+
+    payload = flask.request.get_json(force=True, silent=True) or {}
+    route = payload.get('route')
+    if route is not None and route not in {rule.rule for rule in app.url_map.iter_rules()}:
+        http_json_error(requests.codes['bad_request'], "unknown route")
+    try:
+        rate = float(payload.get('rate', 100))
+        seconds = float(payload.get('seconds', 60))
+    except (TypeError, ValueError):
+        http_json_error(requests.codes['bad_request'], "rate and seconds must be numbers")
+    if not 0 < rate <= 100 or not 0 < seconds <= 3600:
+        http_json_error(requests.codes['bad_request'], "rate must be in (0, 100] and seconds in (0, 3600]")
+
+    profiler.configure(True, route, rate, seconds)
+    return jsonify(profiler.stats())
+
+
+@app.route("/debug/metrics", methods=["GET"])
+def get_debug_metrics():
+    ensure_local_request()
+    return flask.Response(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 # Frontend
@@ -1360,4 +3192,5 @@ def get_index(*args, **kwargs):
 # @app.route("/*")
 
 if __name__ == "__main__":
-    app.run(port=8000, debug=True, threaded=True)
+    # single process development server; production runs `gunicorn -c gunicorn.conf.py app:app`
+    app.run(port=8000, debug=os.getenv('FLASK_DEBUG') == '1', threaded=True)
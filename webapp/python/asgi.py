@@ -0,0 +1,417 @@
+# asyncio variant of the read endpoints, for A/B benchmarking against the WSGI app:
+#
+#   uvicorn asgi:application --port 8001 --workers 2
+#
+# It answers the same routes with the same JSON as app.py, but waits on MySQL (aiomysql) and the
+# shipment service (httpx) without holding a thread, so one process keeps many requests in flight.
+# The SQL, paging and shipping-status rules, JSON helpers and process-local caches come from app.py;
+# the invalidation bus keeps the caches consistent with the WSGI workers writing next to it.
+#
+# Not like-for-like: app.py pages /new_items*.json from its in-memory item timelines and only falls
+# back to these queries, while this app runs them against MySQL on every request.
+
+import asyncio
+import http.cookies
+import os
+import re
+import urllib.parse
+
+import aiomysql
+import httpx
+import itsdangerous
+import pymysql
+import requests
+
+import app as wsgi
+from app import Constants, HttpException, InvalidationBus, Queries
+
+
+class Database(object):
+
+    def __init__(self):
+        self.pool = None
+
+    async def open(self):
+        self.pool = await aiomysql.create_pool(
+            host=os.getenv('MYSQL_HOST', '127.0.0.1'),
+            port=int(os.getenv('MYSQL_PORT', 3306)),
+            user=os.getenv('MYSQL_USER', 'isucari'),
+            password=os.getenv('MYSQL_PASS', 'isucari'),
+            db=os.getenv('MYSQL_DBNAME', 'isucari'),
+            charset='utf8mb4',
+            cursorclass=aiomysql.DictCursor,
+            autocommit=True,
+            init_command="SET SESSION sql_mode='STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION'",
+            minsize=int(os.getenv('ASGI_MYSQL_POOL_MIN_SIZE', 1)),
+            maxsize=int(os.getenv('ASGI_MYSQL_POOL_MAX_SIZE', 50)),
+        )
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def fetchall(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as c:
+                await c.execute(sql, params)
+                return await c.fetchall()
+
+    async def fetchone(self, sql, params=()):
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+    async def execute(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as c:
+                return await c.execute(sql, params)
+
+
+db = Database()
+client = None
+
+# categories and configs only change on /initialize, which resets every process through the bus
+_category_tree = None
+_configs = None
+
+
+@wsgi.on_invalidate(InvalidationBus.CHANNEL_RESET)
+def reset_static_data(keys=None):
+    global _category_tree, _configs
+    _category_tree = None
+    _configs = None
+
+
+async def get_category_tree():
+    global _category_tree
+    if _category_tree is None:
+        _category_tree = wsgi.CategoryTree(await db.fetchall("SELECT * FROM `categories` ORDER BY `id`"))
+    return _category_tree
+
+
+async def get_config(name):
+    global _configs
+    if _configs is None:
+        _configs = {config['name']: config for config in await db.fetchall("SELECT * FROM `configs`")}
+    return _configs.get(name)
+
+
+async def get_payment_service_url():
+    config = await get_config("payment_service_url")
+    return Constants.DEFAULT_PAYMENT_SERVICE_URL if config is None else config['val']
+
+
+async def get_shipment_service_url():
+    config = await get_config("shipment_service_url")
+    return Constants.DEFAULT_SHIPMENT_SERVICE_URL if config is None else config['val']
+
+
+class Request(object):
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.path = scope['path']
+        self.args = {k: v[0] for k, v in urllib.parse.parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+        cookies = http.cookies.SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        self.session = load_session(cookies)
+
+
+def load_session(cookies):
+    # reads the cookie Flask's SecureCookieSessionInterface writes, so a login on either side works on both
+    morsel = cookies.get(wsgi.app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    serializer = wsgi.app.session_interface.get_signing_serializer(wsgi.app)
+    try:
+        return serializer.loads(morsel.value, max_age=int(wsgi.app.permanent_session_lifetime.total_seconds()))
+    except itsdangerous.BadSignature:
+        return {}
+
+
+async def get_user(request):
+    user_id = request.session.get("user_id")
+    if user_id is None:
+        raise HttpException(requests.codes['not_found'], "no session")
+    user = await db.fetchone("SELECT * FROM `users` WHERE `id` = %s", (user_id,))
+    if user is None:
+        raise HttpException(requests.codes['not_found'], "user not found")
+    return user
+
+
+async def get_user_simples_by_ids(user_ids):
+    user_ids = set(user_ids)
+    generation = wsgi.user_cache.generation
+    users = wsgi.user_cache.get_many(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if missing:
+        sql = "SELECT `id`, `account_name`, `num_sell_items` FROM `users` WHERE `id` IN (" + ",".join(["%s"] * len(missing)) + ")"
+        rows = await db.fetchall(sql, missing)
+        wsgi.get_invalidation_bus().poll()
+        for user in rows:
+            users[user['id']] = user
+            wsgi.user_cache.put(user['id'], user, generation)
+    return users
+
+
+async def to_item_jsons(items, simple=False, users=None):
+    if users is None:
+        users = await get_user_simples_by_ids(item["seller_id"] for item in items)
+    tree = await get_category_tree()
+
+    item_jsons = []
+    for item in items:
+        seller = users.get(item["seller_id"])
+        if seller is None:
+            raise HttpException(requests.codes['not_found'], "user not found")
+
+        item["category"] = tree.get(item["category_id"])
+        item["seller"] = wsgi.to_user_json(seller)
+        item["image_url"] = wsgi.get_image_url(item["image_name"])
+        item_jsons.append(wsgi.to_item_json(item, simple=simple))
+    return item_jsons
+
+
+async def api_shipment_status(shipment_url, reserve_id):
+    try:
+        res = await client.post(
+            shipment_url + "/status",
+            headers=dict(Authorization=Constants.ISUCARI_API_TOKEN),
+            json={"reserve_id": reserve_id},
+        )
+        res.raise_for_status()
+    except httpx.HTTPError as err:
+        wsgi.app.logger.exception(err)
+        raise HttpException(requests.codes['internal_server_error'], "failed to request to shipment service")
+    return res.json()
+
+
+async def get_shipping_statuses(shippings):
+    # app.get_shipping_statuses with the service calls and the write-back awaited
+    statuses, pending, generation = wsgi.known_shipping_statuses(shippings)
+    if not pending:
+        return statuses
+
+    shipment_url = await get_shipment_service_url()
+    reserve_ids = sorted(set(pending.values()))
+    try:
+        ssrs = await asyncio.wait_for(
+            asyncio.gather(*(api_shipment_status(shipment_url, reserve_id) for reserve_id in reserve_ids)),
+            timeout=float(os.getenv('SHIPMENT_STATUS_DEADLINE', 5)),
+        )
+    except asyncio.TimeoutError:
+        wsgi.app.logger.error("shipment status deadline exceeded for %d requests", len(reserve_ids))
+        raise HttpException(requests.codes['internal_server_error'], "failed to request to shipment service")
+
+    done = wsgi.record_shipping_statuses(statuses, pending, dict(zip(reserve_ids, ssrs)), generation)
+    if done:
+        await db.execute(*Queries.shippings_done(done))
+    return statuses
+
+
+async def get_new_items(request):
+    item_id, created_at = wsgi.paging_params(request.args)
+
+    items = await db.fetchall(*Queries.new_items(created_at, item_id))
+
+    has_next = len(items) > Constants.ITEMS_PER_PAGE
+    return dict(
+        items=await to_item_jsons(items[:Constants.ITEMS_PER_PAGE], simple=True),
+        has_next=has_next,
+    )
+
+
+async def get_new_category_items(request, root_category_id):
+    if not root_category_id.isdecimal() or int(root_category_id) <= 0:
+        raise HttpException(requests.codes['bad_request'], "incorrect category id")
+
+    tree = await get_category_tree()
+    root_category = tree.get(int(root_category_id))
+    if root_category is None or root_category['parent_id'] != 0:
+        raise HttpException(requests.codes['not_found'], "category not found")
+
+    item_id, created_at = wsgi.paging_params(request.args)
+
+    category_ids = tree.child_ids(root_category["id"])
+    items = []
+    if category_ids:
+        items = await db.fetchall(*Queries.category_items(category_ids, created_at, item_id))
+
+    has_next = len(items) > Constants.ITEMS_PER_PAGE
+    return dict(
+        items=await to_item_jsons(items[:Constants.ITEMS_PER_PAGE], simple=True),
+        root_category_id=root_category["id"],
+        root_category_name=root_category["category_name"],
+        has_next=has_next,
+    )
+
+
+async def get_transactions(request):
+    user = await get_user(request)
+    item_id, created_at = wsgi.paging_params(request.args)
+
+    items = await db.fetchall(*Queries.transactions(user['id'], created_at, item_id))
+
+    items = sorted(items, key=lambda item: (item["created_at"], item["id"]), reverse=True)
+    has_next = len(items) > Constants.TRANSACTIONS_PER_PAGE
+    item_details = await to_item_jsons(items[:Constants.TRANSACTIONS_PER_PAGE], simple=False)
+
+    transaction_evidences = {}
+    shippings = {}
+    if item_details:
+        for transaction_evidence in await db.fetchall(*Queries.transaction_evidences([item["id"] for item in item_details])):
+            transaction_evidences[transaction_evidence["item_id"]] = transaction_evidence
+
+    if transaction_evidences:
+        for shipping in await db.fetchall(*Queries.shippings([transaction_evidence["id"] for transaction_evidence in transaction_evidences.values()])):
+            shippings[shipping["transaction_evidence_id"]] = shipping
+
+    for transaction_evidence in transaction_evidences.values():
+        if transaction_evidence["id"] not in shippings:
+            raise HttpException(requests.codes['not_found'], "shipping not found")
+
+    shipping_statuses = await get_shipping_statuses(shippings.values())
+
+    for item in item_details:
+        transaction_evidence = transaction_evidences.get(item["id"])
+        if transaction_evidence:
+            wsgi.add_transaction_fields(item, transaction_evidence, shipping_statuses)
+
+    return dict(items=item_details, has_next=has_next)
+
+
+async def get_user_items(request, user_id):
+    if not user_id.isdecimal():
+        raise HttpException(requests.codes['not_found'], "user not found")
+    user = (await get_user_simples_by_ids([int(user_id)])).get(int(user_id))
+    if user is None:
+        raise HttpException(requests.codes['not_found'], "user not found")
+
+    item_id, created_at = wsgi.paging_params(request.args)
+
+    items = await db.fetchall(*Queries.user_items(user['id'], created_at, item_id))
+
+    has_next = len(items) > Constants.ITEMS_PER_PAGE
+    return dict(
+        items=await to_item_jsons(items[:Constants.ITEMS_PER_PAGE], simple=True, users={user['id']: user}),
+        user=wsgi.to_user_json(user),
+        has_next=has_next,
+    )
+
+
+async def get_item(request, item_id):
+    user = await get_user(request)
+
+    item = await db.fetchone("SELECT * FROM `items` WHERE `id` = %s", (item_id,))
+    if item is None:
+        raise HttpException(requests.codes['not_found'], "item not found")
+
+    is_party = (user["id"] == item["seller_id"] or user["id"] == item["buyer_id"]) and item["buyer_id"]
+    users = await get_user_simples_by_ids([item["seller_id"], item["buyer_id"]] if is_party else [item["seller_id"]])
+    item = (await to_item_jsons([item], simple=False, users=users))[0]
+
+    if is_party:
+        buyer = users.get(item["buyer_id"])
+        if buyer is None:
+            raise HttpException(requests.codes['not_found'], "user not found")
+        item["buyer"] = wsgi.to_user_json(buyer)
+        item["buyer_id"] = buyer["id"]
+
+        transaction_evidence = await db.fetchone("SELECT * FROM `transaction_evidences` WHERE `item_id` = %s", (item['id'],))
+        if transaction_evidence is None:
+            raise HttpException(requests.codes['not_found'], "transaction_evidence not found")
+        shipping = await db.fetchone(*Queries.shippings([transaction_evidence["id"]]))
+        if not shipping:
+            raise HttpException(requests.codes['not_found'], "shipping not found")
+
+        wsgi.add_transaction_fields(item, transaction_evidence, await get_shipping_statuses([shipping]))
+    else:
+        item["buyer"] = {}
+        item["buyer_id"] = 0
+
+    return item
+
+
+async def get_settings(request):
+    outputs = dict()
+    user_id = request.session.get("user_id")
+    if user_id is not None:
+        user = await db.fetchone("SELECT * FROM `users` WHERE `id` = %s", (user_id,))
+        if user is not None:
+            outputs['user'] = wsgi.to_user_json(user)
+    outputs['csrf_token'] = request.session.get('csrf_token', '')
+    outputs['categories'] = (await get_category_tree()).rows
+    outputs['payment_service_url'] = await get_payment_service_url()
+    return outputs
+
+
+ROUTES = [
+    (re.compile(r'^/new_items\.json$'), get_new_items),
+    (re.compile(r'^/new_items/(?P<root_category_id>[^/]+)\.json$'), get_new_category_items),
+    (re.compile(r'^/users/transactions\.json$'), get_transactions),
+    (re.compile(r'^/users/(?P<user_id>[^/]+)\.json$'), get_user_items),
+    (re.compile(r'^/items/(?P<item_id>[^/]+)\.json$'), get_item),
+    (re.compile(r'^/settings$'), get_settings),
+]
+
+
+async def dispatch(request):
+    if request.scope['method'] not in ('GET', 'HEAD'):
+        raise HttpException(requests.codes['method_not_allowed'], "method not allowed")
+    for pattern, handler in ROUTES:
+        match = pattern.match(request.path)
+        if match:
+            return await handler(request, **match.groupdict())
+    raise HttpException(requests.codes['not_found'], "not found")
+
+
+async def lifespan(receive, send):
+    global client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await db.open()
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=int(os.getenv('SERVICE_CLIENT_POOL_SIZE', 32)),
+                    max_keepalive_connections=int(os.getenv('SERVICE_CLIENT_POOL_SIZE', 32)),
+                ),
+                timeout=httpx.Timeout(
+                    float(os.getenv('SERVICE_CLIENT_READ_TIMEOUT', 5)),
+                    connect=float(os.getenv('SERVICE_CLIENT_CONNECT_TIMEOUT', 1)),
+                ),
+            )
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await client.aclose()
+            await db.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    request = Request(scope)
+    wsgi.get_invalidation_bus().poll()
+    try:
+        status, body = 200, wsgi.json_bytes(await dispatch(request))
+    except HttpException as err:
+        status, body = err.status_code, wsgi.json_bytes({'error': err.message})
+    except pymysql.MySQLError as err:
+        wsgi.app.logger.exception(err)
+        status, body = requests.codes['internal_server_error'], wsgi.json_bytes({'error': "db error"})
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b''})
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Replays the main scenario of the benchmarker against the app and reports throughput and latency per route.
+#
+#   cd webapp/python && python -m bench.replay --users 16 --duration 60 --shipment-latency 0.05
+#
+# Without --target it starts `gunicorn -c gunicorn.conf.py app:app` on a free local port, so the MYSQL_* and
+# GUNICORN_* variables of the environment apply. The payment and shipment services are the in-process
+# stand-ins from bench.services, and /initialize points the app at them.
+#
+# Every virtual user is a seller and a buyer registered for the run. Each round they page the timeline,
+# open a few items, and trade one item: sell, buy, ship, ship_done, complete. The report is written as
+# JSON; pass an earlier one as --baseline to print the differences.
+
+import argparse
+import collections
+import contextlib
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench.services import PaymentService, ServiceError, ShipmentService
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'benchpass'
+IMAGE = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xd9'
+
+
+class ScenarioError(Exception):
+    pass
+
+
+def percentile(timings, p):
+    # nearest rank on sorted timings
+    return timings[max(int(math.ceil(len(timings) * p / 100.0)) - 1, 0)]
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+
+    def record(self, route, seconds, status):
+        with self._lock:
+            self.timings[route].append(seconds)
+            if not 200 <= status < 400:
+                self.errors[route][str(status or 'connection')] += 1
+
+    def report(self, elapsed):
+        routes = collections.OrderedDict()
+        with self._lock:
+            for route in sorted(self.timings):
+                timings = sorted(self.timings[route])
+                routes[route] = dict(
+                    requests=len(timings),
+                    errors=dict(self.errors[route]),
+                    throughput=round(len(timings) / elapsed, 2),
+                    mean_ms=round(sum(timings) / len(timings) * 1000, 2),
+                    p50_ms=round(percentile(timings, 50) * 1000, 2),
+                    p95_ms=round(percentile(timings, 95) * 1000, 2),
+                    p99_ms=round(percentile(timings, 99) * 1000, 2),
+                    max_ms=round(timings[-1] * 1000, 2),
+                )
+        total = sum(route['requests'] for route in routes.values())
+        return dict(
+            seconds=round(elapsed, 2),
+            requests=total,
+            errors=sum(sum(route['errors'].values()) for route in routes.values()),
+            throughput=round(total / elapsed, 2) if elapsed else 0,
+            routes=routes,
+        )
+
+
+class Client(object):
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.csrf_token = None
+
+    def call(self, method, route, path=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.perf_counter()
+        status = 0
+        try:
+            res = self.session.request(method, self.base_url + (path or route), **kwargs)
+            status = res.status_code
+        finally:
+            self.recorder.record('{} {}'.format(method, route), time.perf_counter() - started, status)
+        if status != 200:
+            raise ScenarioError("{} {}: {} {}".format(method, path or route, status, res.text[:200]))
+        return res
+
+    def json(self, method, route, path=None, **kwargs):
+        return self.call(method, route, path, **kwargs).json()
+
+
+def register(client, account_name):
+    client.json('POST', '/register', json=dict(account_name=account_name, password=PASSWORD, address='bench'))
+    settings = client.json('GET', '/settings')
+    client.csrf_token = settings['csrf_token']
+    return settings
+
+
+def browse(client, categories, pages, details):
+    res = client.json('GET', '/new_items.json')
+    seen = list(res['items'])
+    for _ in range(pages - 1):
+        if not res['has_next'] or not res['items']:
+            break
+        last = res['items'][-1]
+        res = client.json('GET', '/new_items.json', '/new_items.json',
+                          params=dict(item_id=last['id'], created_at=last['created_at']))
+        seen += res['items']
+
+    roots = [category['id'] for category in categories if category['parent_id'] == 0]
+    client.json('GET', '/new_items/<root_category_id>.json', '/new_items/{}.json'.format(random.choice(roots)))
+
+    for item in random.sample(seen, min(details, len(seen))):
+        client.json('GET', '/items/<item_id>.json', '/items/{}.json'.format(item['id']))
+
+
+def trade(seller, buyer, payment, shipment, categories):
+    category = random.choice([category for category in categories if category['parent_id'] != 0])
+    item_id = seller.json(
+        'POST', '/sell',
+        data=dict(csrf_token=seller.csrf_token, name='bench', description='bench',
+                  price=random.randint(100, 10000), category_id=category['id']),
+        files=dict(image=('bench.jpg', IMAGE, 'image/jpeg')),
+    )['id']
+    payload = dict(item_id=item_id)
+
+    buyer.json('GET', '/items/<item_id>.json', '/items/{}.json'.format(item_id))
+    buyer.json('POST', '/buy', json=dict(payload, csrf_token=buyer.csrf_token, token=payment.issue_token()))
+
+    reserve_id = seller.json('POST', '/ship', json=dict(payload, csrf_token=seller.csrf_token))['reserve_id']
+    shipment.accept(reserve_id)
+    seller.json('POST', '/ship_done', json=dict(payload, csrf_token=seller.csrf_token))
+    shipment.deliver(reserve_id)
+    buyer.json('POST', '/complete', json=dict(payload, csrf_token=buyer.csrf_token))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def gunicorn(timeout=60):
+    port = free_port()
+    ready_file = os.path.join(tempfile.mkdtemp(prefix='isucari-replay-'), 'ready')
+    env = dict(os.environ, ISUCARI_BIND='127.0.0.1:{}'.format(port), ISUCARI_READY_FILE=ready_file)
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                            cwd=APP_DIR, env=env)
+    try:
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(ready_file):
+            if proc.poll() is not None:
+                raise SystemExit("gunicorn exited with status {}".format(proc.returncode))
+            if time.monotonic() > deadline:
+                raise SystemExit("gunicorn was not ready within {}s".format(timeout))
+            time.sleep(0.1)
+        yield 'http://127.0.0.1:{}'.format(port)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def replay(base_url, args, payment, shipment):
+    setup = Recorder()
+    recorder = Recorder()
+    run_id = '{:x}'.format(int(time.time() * 1000))
+
+    client = Client(base_url, setup, args.timeout)
+    client.json('POST', '/initialize', timeout=args.initialize_timeout, json=dict(
+        payment_service_url=payment.url,
+        shipment_service_url=shipment.url,
+    ))
+
+    def prepare(index):
+        seller = Client(base_url, setup, args.timeout)
+        buyer = Client(base_url, setup, args.timeout)
+        categories = register(seller, 'bench{}s{}'.format(run_id, index))['categories']
+        register(buyer, 'bench{}b{}'.format(run_id, index))
+        seller.recorder = buyer.recorder = recorder
+        return seller, buyer, categories
+
+    counters = collections.Counter()
+    failures = collections.Counter()
+    lock = threading.Lock()
+
+    def run(pair, deadline):
+        seller, buyer, categories = pair
+        while time.monotonic() < deadline:
+            try:
+                browse(buyer, categories, args.pages, args.details)
+                trade(seller, buyer, payment, shipment, categories)
+                outcome = 'completed'
+            except (ScenarioError, ServiceError, requests.RequestException) as err:
+                outcome = 'failed'
+                with lock:
+                    failures[str(err).split(':', 1)[0]] += 1
+            with lock:
+                counters[outcome] += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.users) as executor:
+        started = time.monotonic()
+        pairs = list(executor.map(prepare, range(args.users)))
+        setup_seconds = time.monotonic() - started
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        list(executor.map(lambda pair: run(pair, deadline), pairs))
+        elapsed = time.monotonic() - started
+
+    try:
+        app_stats = client.session.get(base_url + '/debug/stats.json', timeout=args.timeout).json()
+    except (requests.RequestException, ValueError):
+        app_stats = None
+
+    report = recorder.report(elapsed)
+    report.update(
+        trades=dict(
+            completed=counters['completed'],
+            failed=counters['failed'],
+            per_second=round(counters['completed'] / elapsed, 2),
+            failures=dict(failures.most_common(20)),
+        ),
+        setup=setup.report(setup_seconds),
+        services=dict(payment=payment.stats(), shipment=shipment.stats()),
+        app_stats=app_stats,
+    )
+    return report
+
+
+def print_report(report, baseline=None):
+    base_routes = baseline['routes'] if baseline else {}
+    print("{:<40} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8}{}".format(
+        "route", "reqs", "errs", "req/s", "p50 ms", "p95 ms", "p99 ms", "   vs baseline p50/p99" if baseline else ""))
+    for route, stats in report['routes'].items():
+        line = "{:<40} {:>7} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+            route, stats['requests'], sum(stats['errors'].values()), stats['throughput'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+        base = base_routes.get(route)
+        if base:
+            line += "   {:+.1f} / {:+.1f}".format(stats['p50_ms'] - base['p50_ms'], stats['p99_ms'] - base['p99_ms'])
+        print(line)
+
+    trades = report['trades']
+    print("{} requests in {}s, {:.1f} req/s, {} errors; {} trades completed ({:.2f}/s), {} failed".format(
+        report['requests'], report['seconds'], report['throughput'], report['errors'],
+        trades['completed'], trades['per_second'], trades['failed']))
+    if baseline:
+        print("baseline: {:.1f} req/s, {:.2f} trades/s".format(
+            baseline['throughput'], baseline['trades']['per_second']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay the buyer/seller scenario and report latency per route")
+    parser.add_argument('--target', help="base URL of a running app; default: start gunicorn")
+    parser.add_argument('--users', type=int, default=8, help="concurrent seller/buyer pairs")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of replay after setup")
+    parser.add_argument('--pages', type=int, default=3, help="timeline pages per round")
+    parser.add_argument('--details', type=int, default=3, help="item details opened per round")
+    parser.add_argument('--payment-latency', type=float, default=0.0, help="mean seconds per payment call")
+    parser.add_argument('--payment-error-rate', type=float, default=0.0)
+    parser.add_argument('--shipment-latency', type=float, default=0.0, help="mean seconds per shipment call")
+    parser.add_argument('--shipment-error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--initialize-timeout', type=float, default=120)
+    parser.add_argument('--output', help="report path; default: replay-<timestamp>.json")
+    parser.add_argument('--baseline', help="earlier report to compare with")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    payment = PaymentService(args.payment_latency, args.payment_error_rate).start()
+    shipment = ShipmentService(args.shipment_latency, args.shipment_error_rate).start()
+    started_at = datetime.datetime.now()
+    try:
+        with contextlib.ExitStack() as stack:
+            base_url = args.target.rstrip('/') if args.target else stack.enter_context(gunicorn())
+            report = replay(base_url, args, payment, shipment)
+    except ScenarioError as err:
+        raise SystemExit("setup failed: {}".format(err))
+    finally:
+        payment.stop()
+        shipment.stop()
+
+    report = dict(
+        started_at=started_at.isoformat(timespec='seconds'),
+        revision=git_revision(),
+        config=vars(args),
+        **report
+    )
+    output = args.output or started_at.strftime('replay-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print_report(report, baseline)
+    print("report written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
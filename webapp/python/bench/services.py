@@ -0,0 +1,206 @@
+# In-process stand-ins for the payment and shipment services (bench/server/payment.go and shipment.go),
+# with injected latency and error rates. bench.replay starts them on local ports and points the app at
+# them through /initialize.
+#
+# The benchmarker plays the courier and the card form, so those sides are plain methods here:
+# PaymentService.issue_token() is what the browser gets from /card, and ShipmentService.accept() and
+# deliver() move a shipment to `shipping` and `done` the way the delivery person does.
+
+import http.server
+import json
+import random
+import secrets
+import struct
+import threading
+import time
+import zlib
+
+ISUCARI_API_KEY = 'a15400e46c83635eb181-946abb51ff26a868317c'
+ISUCARI_SHOP_ID = '11'
+ISUCARI_API_TOKEN = 'Bearer 75ugk2m37a750fwir5xr-22l6h4wmue1bwrubzwd0'
+
+
+def png(seed, size=32):
+    # a small grayscale image that differs per reserve_id, standing in for the QR code
+    pixels = random.Random(seed).getrandbits(8 * size * size).to_bytes(size * size, 'big')
+    raw = b''.join(b'\x00' + pixels[row * size:(row + 1) * size] for row in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw)) + \
+        chunk(b'IEND', b'')
+
+
+class ServiceError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class StubService(object):
+    # latency is the mean delay in seconds, spread uniformly over 0.5x-1.5x; error_rate is the share of
+    # calls answered with a 500 after the delay
+    routes = {}
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self._lock = threading.Lock()
+        self._server = None
+        self.calls = {}
+        self.injected_errors = 0
+
+    def start(self, host='127.0.0.1', port=0):
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # the app keeps connections to the services alive
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                status, content_type, payload = service.handle(self.path, self.headers, body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, path, headers, body):
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.injected_errors += 1
+            return 500, 'application/json', b'{"error":"injected error"}'
+
+        handler = self.routes.get(path)
+        if handler is None:
+            return 404, 'application/json', b'{"error":"not found"}'
+        try:
+            result = handler(self, headers, json.loads(body.decode('utf-8') or '{}'))
+        except ValueError:
+            return 400, 'application/json', b'{"error":"json decode error"}'
+        except ServiceError as err:
+            return err.status, 'application/json', json.dumps({'error': str(err)}).encode('utf-8')
+        if isinstance(result, bytes):
+            return 200, 'image/png', result
+        return 200, 'application/json', json.dumps(result).encode('utf-8')
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                latency=self.latency,
+                error_rate=self.error_rate,
+                calls=dict(self.calls),
+                injected_errors=self.injected_errors,
+            )
+
+
+class PaymentService(StubService):
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        StubService.__init__(self, latency, error_rate)
+        self._tokens = {}
+
+    def issue_token(self, card_number='AAAAAAAA'):
+        token = secrets.token_hex(20)
+        with self._lock:
+            self._tokens[token] = card_number
+        return token
+
+    def token(self, headers, req):
+        if req.get('shop_id') != ISUCARI_SHOP_ID:
+            raise ServiceError(400, "wrong shop id")
+        if req.get('api_key') != ISUCARI_API_KEY:
+            raise ServiceError(400, "wrong api key")
+        with self._lock:
+            card_number = self._tokens.pop(req.get('token'), None)
+        if card_number is None:
+            return dict(status='invalid')
+        if 'FA10' in card_number:
+            return dict(status='fail')
+        return dict(status='ok')
+
+    routes = {'/token': token}
+
+
+class ShipmentService(StubService):
+    STATUS_INITIAL = 'initial'
+    STATUS_WAIT_PICKUP = 'wait_pickup'
+    STATUS_SHIPPING = 'shipping'
+    STATUS_DONE = 'done'
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        StubService.__init__(self, latency, error_rate)
+        self._shipments = {}
+
+    def _authorize(self, headers):
+        if headers.get('Authorization') != ISUCARI_API_TOKEN:
+            raise ServiceError(401, "unauthorized")
+
+    def _set_status(self, reserve_id, status):
+        with self._lock:
+            shipment = self._shipments.get(reserve_id)
+            if shipment is None:
+                raise ServiceError(400, "empty")
+            shipment['status'] = status
+
+    def create(self, headers, req):
+        self._authorize(headers)
+        if not all(req.get(k) for k in ('to_address', 'to_name', 'from_address', 'from_name')):
+            raise ServiceError(400, "required parameter was not passed")
+        reserve_id = secrets.token_hex(6)
+        reserve_time = int(time.time())
+        with self._lock:
+            self._shipments[reserve_id] = dict(status=self.STATUS_INITIAL, reserve_time=reserve_time)
+        return dict(reserve_id=reserve_id, reserve_time=reserve_time)
+
+    def request(self, headers, req):
+        self._authorize(headers)
+        if not req.get('reserve_id'):
+            raise ServiceError(400, "required parameter was not passed")
+        self._set_status(req['reserve_id'], self.STATUS_WAIT_PICKUP)
+        return png(req['reserve_id'])
+
+    def status(self, headers, req):
+        self._authorize(headers)
+        with self._lock:
+            shipment = self._shipments.get(req.get('reserve_id'))
+            if shipment is None:
+                raise ServiceError(400, "empty")
+            return dict(status=shipment['status'], reserve_time=shipment['reserve_time'])
+
+    def accept(self, reserve_id):
+        self._set_status(reserve_id, self.STATUS_SHIPPING)
+
+    def deliver(self, reserve_id):
+        self._set_status(reserve_id, self.STATUS_DONE)
+
+    routes = {'/create': create, '/request': request, '/status': status}
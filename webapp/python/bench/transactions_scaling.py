@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Measures /users/transactions.json query latency while the items table grows.
+#
+#   cd webapp/python && python -m bench.transactions_scaling --base 50000 --factor 10
+#
+# The rows go into `bench_items`, a scratch copy created LIKE `items` in the app's database (the isucari
+# user has no rights outside it) and dropped again at the end, so the real data is untouched. Run
+# /initialize (or migrate.py) first so the copy gets the migrated indexes. It is a plain table rather than
+# a TEMPORARY one because MySQL 5.7 cannot open a temporary table twice in the UNION ALL query
+# (ERROR 1137).
+#
+# UNMEASURED: the acceptance check for the UNION ALL rewrite (p50/p99 flat while items grows 10x) still
+# needs a run against the provisioned MySQL; paste the printed table here.
+
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+import MySQLdb
+
+import app
+
+TABLE = 'bench_items'
+
+# the query get_transactions used before it was split into two index seeks
+OR_QUERY = "SELECT * FROM `items` WHERE (`seller_id` = %s OR `buyer_id` = %s) AND `status` IN (%s,%s,%s,%s,%s) AND (`created_at` < %s OR (`created_at` <= %s AND `id` < %s)) ORDER BY `created_at` DESC, `id` DESC LIMIT %s"
+
+STATUSES = (
+    app.Constants.ITEM_STATUS_ON_SALE,
+    app.Constants.ITEM_STATUS_TRADING,
+    app.Constants.ITEM_STATUS_SOLD_OUT,
+    app.Constants.ITEM_STATUS_CANCEL,
+    app.Constants.ITEM_STATUS_STOP,
+)
+
+
+def fill(conn, start, stop, users, epoch):
+    sql = "INSERT INTO `" + TABLE + "` (`id`, `seller_id`, `buyer_id`, `status`, `name`, `price`, `description`, `image_name`, `category_id`, `created_at`, `updated_at`) " \
+          "VALUES (%s, %s, %s, %s, 'bench', 1000, 'bench', 'bench.jpg', 2, %s, %s)"
+    with conn.cursor() as c:
+        rows = []
+        for item_id in range(start + 1, stop + 1):
+            created_at = epoch + datetime.timedelta(seconds=item_id)
+            buyer_id = random.randint(1, users) if random.random() < 0.3 else 0
+            status = random.choice(STATUSES[1:3]) if buyer_id else app.Constants.ITEM_STATUS_ON_SALE
+            rows.append((item_id, random.randint(1, users), buyer_id, status, created_at, created_at))
+            if len(rows) == 5000:
+                c.executemany(sql, rows)
+                rows = []
+        if rows:
+            c.executemany(sql, rows)
+        c.execute("ANALYZE TABLE `{}`".format(TABLE))
+        c.fetchall()
+
+
+def measure(conn, sql, params_for, users, repeat):
+    sql = sql.replace("`items`", "`{}`".format(TABLE))
+    timings = []
+    with conn.cursor() as c:
+        for _ in range(repeat):
+            params = params_for(random.randint(1, users))
+            start = time.perf_counter()
+            c.execute(sql, params)
+            c.fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="transactions query latency vs items table size")
+    parser.add_argument('--base', type=int, default=50000, help="items in the first round")
+    parser.add_argument('--factor', type=int, default=10, help="size multiplier of the second round")
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=300)
+    args = parser.parse_args()
+
+    conn = MySQLdb.connect(**app.get_db_pool().connect_args)
+    with conn.cursor() as c:
+        c.execute("DROP TABLE IF EXISTS `{}`".format(TABLE))
+        c.execute("CREATE TABLE `{}` LIKE `items`".format(TABLE))
+
+    epoch = datetime.datetime(2019, 1, 1)
+    cursor_at = epoch + datetime.timedelta(days=365 * 10)
+    limit = app.Constants.TRANSACTIONS_PER_PAGE + 1
+
+    def union_params(user_id):
+        branch = (*STATUSES, cursor_at, cursor_at, 2 ** 62, limit)
+        return (user_id, *branch, user_id, *branch)
+
+    def or_params(user_id):
+        return (user_id, user_id, *STATUSES, cursor_at, cursor_at, 2 ** 62, limit)
+
+    print("{:>10} {:>22} {:>22}".format("items", "OR p50/p99 ms", "UNION ALL p50/p99 ms"))
+    try:
+        size = 0
+        for target in (args.base, args.base * args.factor):
+            fill(conn, size, target, args.users, epoch)
+            size = target
+            or_p50, or_p99 = measure(conn, OR_QUERY, or_params, args.users, args.repeat)
+            union_p50, union_p99 = measure(conn, app.Queries.TRANSACTIONS_PAGING, union_params, args.users, args.repeat)
+            print("{:>10} {:>10.2f} /{:>9.2f} {:>10.2f} /{:>9.2f}".format(size, or_p50, or_p99, union_p50, union_p99))
+    finally:
+        with conn.cursor() as c:
+            c.execute("DROP TABLE IF EXISTS `{}`".format(TABLE))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
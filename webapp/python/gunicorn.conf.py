@@ -0,0 +1,64 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# Every value can be overridden from the environment (see /home/isucon/env.sh), so a configuration
+# can be benchmarked without editing this file; see README.md.
+
+import multiprocessing
+import os
+import random
+import socket
+
+bind = os.getenv('ISUCARI_BIND', '127.0.0.1:8000')
+
+# the app waits on MySQL and the external services most of the time, so a few processes per core
+# keep the CPUs busy while threads inside each process cover the waits
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# import app.py once in the master; workers fork with the code and templates already loaded.
+# Connection pools, the invalidation bus and the service client are created per pid after the fork.
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 10))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG') or None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+
+def sd_notify(state):
+    address = os.getenv('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(state.encode())
+
+
+def when_ready(server):
+    # readiness: the socket is bound and the app is loaded. systemd (Type=notify) gets READY=1,
+    # anything else can wait for ISUCARI_READY_FILE to appear
+    sd_notify("READY=1\nSTATUS=accepting connections on {}".format(bind))
+    ready_file = os.getenv('ISUCARI_READY_FILE')
+    if ready_file:
+        with open(ready_file, 'w') as f:
+            f.write(str(os.getpid()))
+    server.log.info("ready: %d workers x %d threads", workers, threads)
+
+
+def post_fork(server, worker):
+    # with preload every worker would inherit the master's random state and hand out the same
+    # csrf tokens and upload file names
+    random.seed()
+
+
+def on_exit(server):
+    sd_notify("STOPPING=1")
+    ready_file = os.getenv('ISUCARI_READY_FILE')
+    if ready_file and os.path.exists(ready_file):
+        os.unlink(ready_file)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import sys
+
+import MySQLdb
+
+import app
+
+
+def main():
+    conn = MySQLdb.connect(**app.get_db_pool().connect_args)
+    try:
+        for version in app.run_migrations(conn):
+            print("applied {}".format(version))
+
+        problems = app.explain_listing_queries(conn)
+    finally:
+        conn.close()
+
+    for problem in problems:
+        print("query plan: {}".format(problem), file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+-- Every listing query orders by (created_at, id). status and category_id are appended so the
+-- timeline filters are evaluated inside the index instead of on the clustered rows.
+ALTER TABLE `items`
+  DROP INDEX `idx_category_id`,
+  ADD INDEX `idx_created_at` (`created_at`, `id`, `status`, `category_id`),
+  ADD INDEX `idx_seller_id_created_at` (`seller_id`, `created_at`, `id`, `status`),
+  ADD INDEX `idx_buyer_id_created_at` (`buyer_id`, `created_at`, `id`, `status`);
@@ -0,0 +1,7 @@
+-- QR code PNGs are kept in the content-addressed file store (QRCODE_DIR) and only their sha256 is
+-- stored here, so shipping queries no longer carry image bytes. A separate table avoids rebuilding
+-- `shippings` with an ALTER on every /initialize and keeps the shared schema intact.
+CREATE TABLE `shipping_images` (
+  `transaction_evidence_id` bigint NOT NULL PRIMARY KEY,
+  `img_hash` char(64) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARACTER SET utf8mb4;
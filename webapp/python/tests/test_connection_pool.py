@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+from app import ConnectionPool, PoolTimeout
+
+
+class FakeConnection(object):
+    in_transaction = False
+
+    def __init__(self):
+        self.closed = False
+        self.pings = 0
+
+    def ping(self):
+        self.pings += 1
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+    # the pool logic without MySQL; fail_connects makes the next connects raise
+    def __init__(self, **kwargs):
+        ConnectionPool.__init__(self, {}, **kwargs)
+        self.fail_connects = 0
+
+    def _connect(self):
+        with self._cond:
+            if self.fail_connects:
+                self.fail_connects -= 1
+                raise RuntimeError("connect failed")
+            self.connects += 1
+        return FakeConnection()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_fills_min_size_and_reuses(self):
+        pool = FakePool(min_size=2, max_size=4)
+        conn = pool.acquire()
+        self.assertEqual(pool.stats()['size'], 2)
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['connects'], 2)
+
+    def test_retries_fill_after_failure(self):
+        pool = FakePool(min_size=2, max_size=4)
+        pool.fail_connects = 1
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+        pool.acquire()
+        self.assertEqual(pool.stats()['size'], 2)
+
+    def test_times_out_when_exhausted(self):
+        pool = FakePool(min_size=1, max_size=1, timeout=0.05)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        stats = pool.stats()
+        self.assertEqual((stats['exhausted'], stats['timeouts']), (1, 1))
+
+    def test_waiter_gets_released_connection(self):
+        pool = FakePool(min_size=1, max_size=1, timeout=5.0)
+        conn = pool.acquire()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+        waiter.start()
+        pool.release(conn)
+        waiter.join(5.0)
+        self.assertEqual(got, [conn])
+
+    def test_discard_frees_a_slot(self):
+        pool = FakePool(min_size=1, max_size=1, timeout=0.05)
+        conn = pool.acquire()
+        pool.discard(conn)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_failed_connect_frees_a_slot(self):
+        pool = FakePool(min_size=0, max_size=1, timeout=0.05)
+        pool.fail_connects = 1
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+        pool.acquire()
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_rolls_back_open_transactions_on_release(self):
+        pool = FakePool(min_size=1, max_size=1)
+        conn = pool.acquire()
+        conn.in_transaction = True
+        pool.release(conn)
+        self.assertFalse(pool.acquire().in_transaction)
+
+
+if __name__ == '__main__':
+    unittest.main()
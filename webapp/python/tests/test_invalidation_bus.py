@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import InvalidationBus
+
+
+class Recorder(object):
+
+    def __init__(self, bus, *channels):
+        self.calls = []
+        for channel in channels:
+            bus.subscribe(channel, lambda keys, channel=channel: self.calls.append((channel, keys)))
+
+
+class InvalidationBusTest(unittest.TestCase):
+    CAPACITY = 4
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bus')
+        # two handles on the same file stand in for two worker processes
+        self.writer = InvalidationBus(self.path, capacity=self.CAPACITY)
+        self.reader = InvalidationBus(self.path, capacity=self.CAPACITY)
+        self.recorder = Recorder(self.reader, InvalidationBus.CHANNEL_USER, InvalidationBus.CHANNEL_ITEM)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_delivers_keys_per_channel(self):
+        self.writer.publish(InvalidationBus.CHANNEL_USER, (1, 2))
+        self.writer.publish(InvalidationBus.CHANNEL_ITEM, (3,))
+        self.reader.poll()
+        self.assertEqual(sorted(self.recorder.calls), [
+            (InvalidationBus.CHANNEL_USER, [1, 2]),
+            (InvalidationBus.CHANNEL_ITEM, [3]),
+        ])
+        self.assertEqual(self.reader.cursor, 3)
+
+        self.recorder.calls = []
+        self.reader.poll()
+        self.assertEqual(self.recorder.calls, [])
+
+    def test_delivers_across_the_ring_boundary(self):
+        for round_ in range(5):
+            self.writer.publish(InvalidationBus.CHANNEL_ITEM, (round_ * 10 + 1, round_ * 10 + 2, round_ * 10 + 3))
+            self.reader.poll()
+            self.assertEqual(self.recorder.calls, [(InvalidationBus.CHANNEL_ITEM, [round_ * 10 + 1, round_ * 10 + 2, round_ * 10 + 3])])
+            self.recorder.calls = []
+        self.assertEqual(self.reader.seq(), 15)
+        self.assertEqual(self.reader.stats()['overflows'], 0)
+        self.assertEqual(self.reader.stats()['received'], 15)
+
+    def test_exactly_capacity_behind(self):
+        self.writer.publish(InvalidationBus.CHANNEL_USER, (1, 2))
+        self.reader.poll()
+        self.recorder.calls = []
+
+        self.writer.publish(InvalidationBus.CHANNEL_USER, tuple(range(10, 10 + self.CAPACITY)))
+        self.reader.poll()
+        self.assertEqual(self.recorder.calls, [(InvalidationBus.CHANNEL_USER, list(range(10, 10 + self.CAPACITY)))])
+        self.assertEqual(self.reader.stats()['overflows'], 0)
+
+    def test_overflow_resets_every_subscriber(self):
+        self.writer.publish(InvalidationBus.CHANNEL_USER, tuple(range(self.CAPACITY + 1)))
+        self.reader.poll()
+        self.assertEqual(sorted(self.recorder.calls), [
+            (InvalidationBus.CHANNEL_USER, None),
+            (InvalidationBus.CHANNEL_ITEM, None),
+        ])
+        self.assertEqual(self.reader.stats()['overflows'], 1)
+        self.assertEqual(self.reader.cursor, self.CAPACITY + 1)
+
+        # back in step after the reset
+        self.recorder.calls = []
+        self.writer.publish(InvalidationBus.CHANNEL_ITEM, (42,))
+        self.reader.poll()
+        self.assertEqual(self.recorder.calls, [(InvalidationBus.CHANNEL_ITEM, [42])])
+
+    def test_overflow_after_wrapping(self):
+        self.writer.publish(InvalidationBus.CHANNEL_USER, (1, 2, 3))
+        self.reader.poll()
+        self.recorder.calls = []
+
+        for key in range(self.CAPACITY * 2 + 1):
+            self.writer.publish(InvalidationBus.CHANNEL_ITEM, (key,))
+        self.reader.poll()
+        self.assertEqual(sorted(self.recorder.calls), [
+            (InvalidationBus.CHANNEL_USER, None),
+            (InvalidationBus.CHANNEL_ITEM, None),
+        ])
+
+    def test_reset_channel(self):
+        self.writer.publish(InvalidationBus.CHANNEL_ITEM, (1,))
+        self.writer.publish(InvalidationBus.CHANNEL_RESET)
+        self.reader.poll()
+        self.assertEqual(sorted(self.recorder.calls), [
+            (InvalidationBus.CHANNEL_USER, None),
+            (InvalidationBus.CHANNEL_ITEM, None),
+        ])
+        self.assertEqual(self.reader.stats()['overflows'], 0)
+
+    def test_publisher_sees_its_own_changes(self):
+        recorder = Recorder(self.writer, InvalidationBus.CHANNEL_SHIPPING)
+        self.writer.publish(InvalidationBus.CHANNEL_SHIPPING, (7,))
+        self.assertEqual(recorder.calls, [(InvalidationBus.CHANNEL_SHIPPING, [7])])
+
+    def test_reinitializes_a_file_with_another_capacity(self):
+        self.writer.publish(InvalidationBus.CHANNEL_USER, (1, 2))
+        bus = InvalidationBus(self.path, capacity=self.CAPACITY * 2)
+        self.assertEqual(bus.seq(), 0)
+        self.assertEqual(os.path.getsize(self.path), InvalidationBus.HEADER.size + InvalidationBus.ENTRY.size * self.CAPACITY * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import app
+
+
+def item_row(item_id, name):
+    now = datetime.datetime(2019, 9, 8, 12, 0, 0)
+    return dict(id=item_id, seller_id=1, buyer_id=0, status='on_sale', name=name, price=100, description='',
+                image_name='x.jpg', category_id=2, created_at=now, updated_at=now)
+
+
+class ItemFragmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = os.environ.get('ISUCARI_BUS_PATH')
+        os.environ['ISUCARI_BUS_PATH'] = os.path.join(self.dir, 'bus')
+        app._bus = None
+        app._category_tree = app.CategoryTree([
+            dict(id=1, parent_id=0, category_name='root'),
+            dict(id=2, parent_id=1, category_name='child'),
+        ])
+        app.item_fragments.invalidate()
+
+    def tearDown(self):
+        app.item_fragments.invalidate()
+        app._category_tree = None
+        app._bus = None
+        if self.env is None:
+            del os.environ['ISUCARI_BUS_PATH']
+        else:
+            os.environ['ISUCARI_BUS_PATH'] = self.env
+        shutil.rmtree(self.dir)
+
+    def cached_name(self, item_id):
+        fragment = app.item_fragments.get_many([item_id]).get(item_id)
+        return None if fragment is None else json.loads(fragment[1].decode())['name']
+
+    def test_caches_rows_it_loads(self):
+        fragments = app.get_item_fragments([1], lambda item_ids: {1: item_row(1, 'a')})
+        self.assertEqual(json.loads(fragments[0][1].decode())['name'], 'a')
+        self.assertEqual(self.cached_name(1), 'a')
+
+    def test_rows_selected_before_an_invalidation_are_not_cached(self):
+        generation = app.item_fragments.generation
+        stale = {1: item_row(1, 'old')}
+        # another thread applies an invalidation between the caller's SELECT and this call
+        app.item_fragments.invalidate([1])
+        fragments = app.get_item_fragments([1], lambda item_ids: stale, generation)
+        self.assertEqual(json.loads(fragments[0][1].decode())['name'], 'old')
+        self.assertIsNone(self.cached_name(1))
+
+        app.get_item_fragments([1], lambda item_ids: {1: item_row(1, 'new')})
+        self.assertEqual(self.cached_name(1), 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from app import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a', cache.generation)
+        cache.put(2, 'b', cache.generation)
+        self.assertEqual(cache.get_many([1]), {1: 'a'})
+        cache.put(3, 'c', cache.generation)
+        self.assertEqual(cache.get_many([1, 2, 3]), {1: 'a', 3: 'c'})
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_drops_values_loaded_before_an_invalidation(self):
+        cache = LRUCache(10)
+        generation = cache.generation
+        cache.invalidate([1])
+        cache.put(1, 'stale', generation)
+        self.assertEqual(cache.get_many([1]), {})
+
+        cache.put(1, 'fresh', cache.generation)
+        self.assertEqual(cache.get_many([1]), {1: 'fresh'})
+
+    def test_invalidate(self):
+        cache = LRUCache(10)
+        for key in range(3):
+            cache.put(key, str(key), cache.generation)
+        cache.invalidate([0, 5])
+        self.assertEqual(cache.get_many([0, 1, 2]), {1: '1', 2: '2'})
+        cache.invalidate()
+        self.assertEqual(cache.get_many([0, 1, 2]), {})
+        self.assertEqual(cache.stats()['invalidations'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+from app import QueryStats
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = QueryStats()
+
+    def test_in_lists_share_one_shape(self):
+        shapes = {
+            self.stats.normalize(query) for query in (
+                "SELECT * FROM `items` WHERE `id` IN (%s)",
+                "SELECT * FROM `items` WHERE `id` IN (%s,%s,%s)",
+                "SELECT * FROM `items` WHERE `id` in ( %s , %s )",
+                "SELECT * FROM `items` WHERE `id` IN (1, 2)",
+            )
+        }
+        self.assertEqual(shapes, {"SELECT * FROM `items` WHERE `id` IN (...)"})
+
+    def test_literals(self):
+        self.assertEqual(
+            self.stats.normalize("SELECT * FROM `users` WHERE `account_name` = 'it''s'  AND `id` > 10"),
+            "SELECT * FROM `users` WHERE `account_name` = ? AND `id` > ?")
+
+    def test_values_keep_their_arity(self):
+        self.assertEqual(
+            self.stats.normalize("INSERT INTO `configs` (`name`, `val`) VALUES (%s, %s)"),
+            "INSERT INTO `configs` (`name`, `val`) VALUES (?, ?)")
+
+
+if __name__ == '__main__':
+    unittest.main()
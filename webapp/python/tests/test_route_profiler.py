@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from app import RouteProfiler
+
+
+class RouteProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.dir, 'profile.json')
+        self.output_dir = os.path.join(self.dir, 'out')
+        self.profiler = RouteProfiler(self.config_path, self.output_dir, interval=0.001)
+
+    def tearDown(self):
+        self.profiler.stop()
+        shutil.rmtree(self.dir)
+
+    def write_config(self, enabled, seconds=60.0, session='s1'):
+        # what configure() writes, without telling the other processes through the bus
+        with open(self.config_path + '.tmp', 'w') as f:
+            json.dump(dict(enabled=enabled, route=None, rate=100.0, expires_at=time.time() + seconds,
+                           session=session), f)
+        os.replace(self.config_path + '.tmp', self.config_path)
+
+    def run_request(self, route):
+        def request():
+            self.profiler.start(route)
+            time.sleep(0.02)
+            self.profiler.finish()
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def output_files(self, session='s1'):
+        directory = os.path.join(self.output_dir, session)
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def test_idle_worker_writes_output_when_disabled(self):
+        self.write_config(True)
+        self.profiler.reload()
+        self.run_request('/items/<item_id>.json')
+        self.assertEqual(self.profiler.stats()['requests'], {'/items/<item_id>.json': 1})
+
+        # no request and no bus message reach this worker after the switch
+        self.write_config(False)
+        # stop() clears the flag before it writes the files
+        self.assertTrue(self.wait_for(lambda: len(self.output_files()) == 2))
+        self.assertFalse(self.profiler.enabled)
+        pid = os.getpid()
+        self.assertEqual(self.output_files(), [
+            'items_item_id_.json.{}.folded'.format(pid),
+            'items_item_id_.json.{}.pstats'.format(pid),
+        ])
+
+    def test_idle_worker_writes_output_when_expired(self):
+        self.write_config(True, seconds=0.1)
+        self.profiler.reload()
+        self.run_request('/settings')
+        self.assertTrue(self.wait_for(lambda: len(self.output_files()) == 2))
+        self.assertFalse(self.profiler.enabled)
+
+    def test_request_running_across_sessions_is_dropped(self):
+        self.write_config(True, session='s1')
+        self.profiler.reload()
+        self.profiler.start('/settings')
+        self.write_config(True, session='s2')
+        self.profiler.reload()
+        self.profiler.finish()
+        self.assertEqual(self.profiler.stats()['session'], 's2')
+        self.assertEqual(self.profiler.stats()['requests'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
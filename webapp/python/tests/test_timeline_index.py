@@ -0,0 +1,98 @@
+import unittest
+
+from app import TimelineIndex
+
+
+def sql_page(items, created_at, item_id, limit):
+    # what the listing queries return: ORDER BY created_at DESC, id DESC with the keyset predicate
+    # (created_at < ? OR (created_at <= ? AND id < ?)) when both paging parameters are given
+    rows = sorted(items, key=lambda item: (item[1], item[0]), reverse=True)
+    if item_id > 0 and created_at > 0:
+        rows = [r for r in rows if r[1] < created_at or (r[1] <= created_at and r[0] < item_id)]
+    return [r[0] for r in rows[:limit]]
+
+
+def index_of(items):
+    return TimelineIndex((-created_at, -item_id) for item_id, created_at in items)
+
+
+class TimelineIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        # (id, created_at) with ties on created_at, ids not in created_at order
+        self.items = [
+            (1, 100), (2, 100), (3, 100),
+            (4, 200), (7, 200),
+            (5, 150),
+            (6, 300),
+            (8, 90), (9, 90),
+        ]
+        self.index = index_of(self.items)
+
+    def assertPage(self, created_at, item_id, limit):
+        self.assertEqual(
+            self.index.page(created_at, item_id, limit),
+            sql_page(self.items, created_at, item_id, limit),
+            (created_at, item_id, limit))
+
+    def test_first_page(self):
+        self.assertEqual(self.index.page(0, 0, 3), [6, 7, 4])
+
+    def test_first_page_needs_both_parameters(self):
+        self.assertEqual(self.index.page(200, 0, 3), [6, 7, 4])
+        self.assertEqual(self.index.page(0, 7, 3), [6, 7, 4])
+
+    def test_ties_break_by_id(self):
+        self.assertEqual(self.index.page(100, 3, 10), [2, 1, 9, 8])
+        self.assertEqual(self.index.page(200, 7, 1), [4])
+
+    def test_cursor_at_each_item(self):
+        for item_id, created_at in self.items:
+            for limit in (1, 2, 3, len(self.items) + 1):
+                self.assertPage(created_at, item_id, limit)
+
+    def test_cursor_not_in_index(self):
+        for created_at in (1, 90, 95, 100, 250, 301, 1000):
+            for item_id in (1, 5, 10, 100):
+                self.assertPage(created_at, item_id, 3)
+
+    def test_walk_all_pages(self):
+        seen = []
+        created_at = item_id = 0
+        created = dict(self.items)
+        while True:
+            page = self.index.page(created_at, item_id, 2)
+            if not page:
+                break
+            seen.extend(page)
+            item_id = page[-1]
+            created_at = created[item_id]
+        self.assertEqual(seen, sql_page(self.items, 0, 0, len(self.items)))
+
+    def test_last_item_and_limit_edges(self):
+        self.assertEqual(self.index.page(90, 8, 5), [])
+        self.assertEqual(self.index.page(90, 9, 5), [8])
+        self.assertEqual(self.index.page(0, 0, 0), [])
+        self.assertEqual(len(self.index.page(0, 0, 100)), len(self.items))
+
+    def test_add_and_discard(self):
+        self.index.add((-100, -10))
+        self.items.append((10, 100))
+        self.assertPage(100, 3, 5)
+        self.assertPage(150, 5, 5)
+
+        self.index.discard((-200, -7))
+        self.items.remove((7, 200))
+        self.assertPage(0, 0, 3)
+        self.assertPage(300, 6, 2)
+
+        self.index.discard((-200, -7))
+        self.assertEqual(len(self.index), len(self.items))
+
+    def test_empty(self):
+        self.assertEqual(TimelineIndex().page(0, 0, 10), [])
+        self.assertEqual(TimelineIndex().page(100, 1, 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()